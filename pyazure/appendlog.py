@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Python wrapper around Windows Azure storage and management APIs
+
+Authors:
+    Sriram Krishnan <sriramk@microsoft.com>
+    Steve Marx <steve.marx@microsoft.com>
+    Tihomir Petkov <tpetkov@gmail.com>
+
+License:
+    GNU General Public Licence (GPL)
+    
+    This file is part of pyazure.
+    
+    pyazure is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pyazure is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with pyazure. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+
+from util import *
+from blob import MAX_BLOCK_SIZE, make_block_id
+
+# Most blocks a block blob can hold
+MAX_BLOCKS = 50000
+
+class AppendLogWriter(object):
+    """Appends records to a series of block blobs named prefix plus a UTC
+    timestamp and sequence number, without ever rewriting written data.
+
+    append only buffers the record. A background thread stages the buffer
+    as a block once it holds block_size bytes or its oldest record is
+    flush_interval seconds old, and every commit_interval seconds commits
+    the blob's committed blocks followed by the newly staged ones. Records
+    become visible with the commit that includes them, so a crash loses at
+    most the last commit_interval seconds. A new blob is started when the
+    current one would grow past max_blob_size or MAX_BLOCKS blocks.
+
+    Failed requests are logged and retried on the next cycle; meanwhile
+    append blocks once max_buffered bytes are waiting. Writers sharing a
+    container should use distinct prefixes."""
+
+    def __init__(self, blobs, container_name, prefix,
+            block_size=1024 * 1024, flush_interval=1.0, commit_interval=10.0,
+            max_blob_size=1024 * 1024 * 1024,
+            max_buffered=16 * 1024 * 1024, content_type="text/plain",
+            separator="\n"):
+        if not 0 < block_size <= MAX_BLOCK_SIZE:
+            raise ValueError("block_size must be between 1 and %d"
+                % MAX_BLOCK_SIZE)
+        self._blobs = blobs
+        self.container_name = container_name
+        self.prefix = prefix
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.commit_interval = commit_interval
+        self.max_blob_size = max_blob_size
+        self.max_buffered = max_buffered
+        self.content_type = content_type
+        self.separator = separator
+        self.blob_names = []
+
+        # _lock guards the record buffer, _io_lock the blob state below it
+        self._lock = threading.Condition()
+        self._records = []
+        self._buffered = 0
+        self._first_buffered = None
+        self._closed = False
+        self._io_lock = threading.Lock()
+        self._pending = []
+        self._new_blob()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def blob_name(self):
+        return self.blob_names[-1]
+
+    def append(self, record):
+        """Buffers record, followed by the separator."""
+        record += self.separator
+        with self._lock:
+            while self._buffered >= self.max_buffered and not self._closed:
+                self._lock.wait(1.0)
+            if self._closed:
+                raise ValueError("append to a closed AppendLogWriter")
+            self._records.append(record)
+            self._buffered += len(record)
+            if self._first_buffered is None:
+                self._first_buffered = time.time()
+            if self._buffered >= self.block_size:
+                self._lock.notify_all()
+
+    def flush(self):
+        """Stages and commits everything appended so far."""
+        self._cycle(True)
+
+    def close(self):
+        """Stops the background thread and flushes."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._lock.notify_all()
+        self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._buffered < self.block_size and not self._closed:
+                    self._lock.wait(self.flush_interval)
+                if self._closed:
+                    return
+            try:
+                self._cycle(False)
+            except Exception, e:
+                log.warning("Append log %s/%s: %s; retrying",
+                    self.container_name, self.blob_name, e)
+                time.sleep(self.flush_interval)
+
+    def _cycle(self, force):
+        with self._io_lock:
+            self._take(force)
+            while self._pending:
+                data = self._pending[0]
+                if len(self._block_list) >= MAX_BLOCKS or (self._blob_size
+                        and self._blob_size + len(data) > self.max_blob_size):
+                    self._commit()
+                    self._new_blob()
+                block_id = make_block_id(len(self._block_list), data)
+                code = self._blobs.put_block(self.container_name,
+                    self.blob_name, block_id, data)
+                if code != 201:
+                    raise WAError("Put Block to %s/%s returned %d"
+                        % (self.container_name, self.blob_name, code))
+                self._block_list.append(block_id)
+                self._blob_size += len(data)
+                self._pending.pop(0)
+            if len(self._block_list) > self._committed and (force or
+                    time.time() - self._last_commit >= self.commit_interval):
+                self._commit()
+
+    def _take(self, force):
+        """Moves the record buffer to the blocks waiting to be staged when
+        it is due, unless too many are waiting already."""
+        if not force and sum(map(len, self._pending)) >= self.max_buffered:
+            return
+        with self._lock:
+            if not self._records or not (force or
+                    self._buffered >= self.block_size or
+                    time.time() - self._first_buffered >= self.flush_interval):
+                return
+            data = "".join(self._records)
+            self._records = []
+            self._buffered = 0
+            self._first_buffered = None
+            self._lock.notify_all()
+        self._pending.extend(data[i:i + self.block_size]
+                             for i in xrange(0, len(data), self.block_size))
+
+    def _commit(self):
+        block_list = [(block_id, "Committed")
+                      for block_id in self._block_list[:self._committed]]
+        block_list.extend((block_id, "Uncommitted")
+                          for block_id in self._block_list[self._committed:])
+        code = self._blobs.put_block_list(self.container_name,
+            self.blob_name, block_list, self.content_type)
+        if code != 201:
+            raise WAError("Put Block List of %s/%s returned %d"
+                % (self.container_name, self.blob_name, code))
+        self._committed = len(self._block_list)
+        self._last_commit = time.time()
+
+    def _new_blob(self):
+        self.blob_names.append("%s%s-%04d" % (self.prefix,
+            time.strftime("%Y%m%dT%H%M%SZ", time.gmtime()),
+            len(self.blob_names)))
+        self._block_list = []
+        self._committed = 0
+        self._blob_size = 0
+        self._last_commit = time.time()
@@ -27,15 +27,434 @@ License:
     along with pyazure. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import base64
+import hashlib
+import os
+import Queue
+import threading
 import time
+import zlib
+from collections import OrderedDict
 try:
     from lxml import etree
 except ImportError:
     from xml.etree import ElementTree as etree
-from urllib2 import Request, urlopen, URLError
+from urllib import quote
+from urllib2 import Request, urlopen, URLError, HTTPError
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 from util import *
 
+# Largest blob that can be uploaded with a single Put Blob request
+MAX_SINGLE_PUT_SIZE = 64 * 1024 * 1024
+# Largest block accepted by Put Block
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+# Page blobs are written in 512 byte pages, at most 4MB per Put Page
+PAGE_SIZE = 512
+MAX_PAGE_WRITE_SIZE = 4 * 1024 * 1024
+ZERO_PAGE = "\0" * PAGE_SIZE
+# Size of the byte ranges fetched by get_blob_into
+DOWNLOAD_RANGE_SIZE = 4 * 1024 * 1024
+# Size of the reads from a response body
+READ_SIZE = 64 * 1024
+# Size of the blocks BlobReader fetches and caches
+READER_BLOCK_SIZE = 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+# Number of blobs list_blobs_parallel workers hand over at a time, and how
+# many such batches each prefix may buffer when listing in order
+LIST_BATCH_SIZE = 1000
+LIST_BATCHES_BUFFERED = 4
+
+# Metadata names recording the codec a blob was compressed with and its
+# uncompressed size
+CODEC_METADATA = "pyazurecodec"
+SIZE_METADATA = "pyazuresize"
+CODEC_HEADER = PREFIX_STORAGE_HEADER + "meta-" + CODEC_METADATA
+SIZE_HEADER = PREFIX_STORAGE_HEADER + "meta-" + SIZE_METADATA
+
+class Codec(object):
+    """Streaming compression format for blobs. name is recorded in the
+    blob's metadata; content_encoding, the matching HTTP Content-Encoding,
+    is set on the blob when there is one. compressor and decompressor make
+    objects with the compress/flush and decompress (and optionally flush)
+    methods of zlib's."""
+
+    def __init__(self, name, content_encoding, compressor, decompressor):
+        self.name = name
+        self.content_encoding = content_encoding
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+    def __repr__(self):
+        return "Codec(%r)" % self.name
+
+class _LZ4Compressor(object):
+    def __init__(self):
+        self._compressor = lz4.frame.LZ4FrameCompressor()
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        data = self._header + self._compressor.compress(data)
+        self._header = ""
+        return data
+
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+CODECS = {
+    "gzip": Codec("gzip", "gzip",
+        lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+        lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    "zlib": Codec("zlib", "deflate", zlib.compressobj, zlib.decompressobj),
+}
+if lz4 is not None:
+    CODECS["lz4"] = Codec("lz4", None, _LZ4Compressor,
+        lz4.frame.LZ4FrameDecompressor)
+
+def get_codec(codec):
+    """Returns the Codec given or named by codec."""
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise WAError("Unknown or unavailable codec %r" % codec)
+
+class _Encoder(object):
+    """Iterable of the compressed chunks of data, which also measures the
+    uncompressed size and the MD5 of the compressed bytes."""
+
+    def __init__(self, codec, data):
+        self.codec = codec
+        self.size = 0
+        self._data = data
+        self._md5 = hashlib.md5()
+
+    def __iter__(self):
+        compressor = self.codec.compressor()
+        for chunk in iter_chunks(self._data, READ_SIZE):
+            # compressors only take strings and read-only buffers
+            if isinstance(chunk, memoryview):
+                chunk = chunk.tobytes()
+            elif isinstance(chunk, bytearray):
+                chunk = str(chunk)
+            self.size += len(chunk)
+            compressed = compressor.compress(chunk)
+            if compressed:
+                self._md5.update(compressed)
+                yield compressed
+        compressed = compressor.flush()
+        self._md5.update(compressed)
+        yield compressed
+
+    @property
+    def content_md5(self):
+        return base64.b64encode(self._md5.digest())
+
+    @property
+    def metadata(self):
+        return {CODEC_METADATA: self.codec.name, SIZE_METADATA: str(self.size)}
+
+def make_block_id(index, data):
+    """Returns the block ID for the index-th block of a blob. All block IDs of
+    a blob must have the same length, the MD5 of the block keeps them unique
+    per content."""
+    return base64.b64encode("%08d-%s" % (index, hashlib.md5(data).hexdigest()))
+
+def get_block_md5(block_id):
+    """Returns the hex MD5 recorded in a make_block_id block ID, or None for
+    block IDs made otherwise."""
+    try:
+        index, md5 = base64.b64decode(block_id).split("-", 1)
+    except (TypeError, ValueError):
+        return None
+    if len(index) != 8 or not index.isdigit() or len(md5) != 32:
+        return None
+    return md5
+
+class BlockJournal(object):
+    """Local file recording the blocks staged by a put_block_blob upload, so
+    that an interrupted upload can be resumed. Its first line identifies the
+    upload, every other line is the ID of a staged block."""
+
+    def __init__(self, path, container_name, blob_name, block_size):
+        self.path = path
+        header = "%s/%s %d" % (container_name, blob_name, block_size)
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except IOError:
+            lines = []
+        if lines and lines[0] == header:
+            self.block_ids = set(lines[1:])
+            self._file = open(path, "a")
+        else:
+            self.block_ids = set()
+            self._file = open(path, "w")
+            self._file.write(header + "\n")
+            self._file.flush()
+        self._lock = threading.Lock()
+
+    def record(self, block_id):
+        with self._lock:
+            self._file.write(block_id + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+class Blob(object):
+    """Blob entry of a listing. It unpacks like the (name, etag,
+    last_modified) tuples list_blobs used to yield; last_modified is kept as
+    the service's string and only parsed when unpacking."""
+
+    __slots__ = ("name", "etag", "last_modified", "size", "content_type",
+                 "content_encoding", "content_md5", "blob_type", "metadata")
+
+    def __init__(self, name, etag=None, last_modified=None, size=None,
+            content_type=None, content_encoding=None, content_md5=None,
+            blob_type=None, metadata=None):
+        self.name = name
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.content_md5 = content_md5
+        self.blob_type = blob_type
+        self.metadata = metadata
+
+    def __iter__(self):
+        return iter((self.name, self.etag,
+                     time.strptime(self.last_modified, TIME_FORMAT)))
+
+    def __repr__(self):
+        return "Blob(%r)" % self.name
+
+class BlobPrefix(object):
+    """Virtual directory returned by a listing made with a delimiter."""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "BlobPrefix(%r)" % self.name
+
+class _LevelSlice(object):
+    """Blobs listed with a delimiter directly under prefix whose names fall
+    between the sub-prefixes after and before, either of which may be
+    None."""
+
+    __slots__ = ("prefix", "after", "before")
+
+    def __init__(self, prefix, after, before):
+        self.prefix = prefix
+        self.after = after
+        self.before = before
+
+    def __repr__(self):
+        return "_LevelSlice(%r, %r, %r)" % (self.prefix, self.after,
+            self.before)
+
+class BlobStream(object):
+    """Read-only file-like object over the body of a Get Blob response,
+    consumed as it arrives from the network. A blob uploaded with a codec
+    is decompressed as it is read unless decode is false; length is then
+    its uncompressed size."""
+
+    def __init__(self, response, decode=True):
+        self._response = response
+        self.headers = dict(response.headers.items())
+        self.length = int(self.headers["content-length"])
+        self.etag = self.headers.get("etag")
+        self.content_type = self.headers.get("content-type")
+        self.closed = False
+        self._decompressor = None
+        codec = self.headers.get(CODEC_HEADER)
+        if decode and codec:
+            self._decompressor = get_codec(codec).decompressor()
+            self._buffer = ""
+            self._eof = False
+            self.length = int(self.headers[SIZE_HEADER])
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        if self._decompressor is not None:
+            return self._read_decoded(size)
+        if size < 0:
+            return self._response.read()
+        return self._response.read(size)
+
+    def readinto(self, buf):
+        """Fills buf (a bytearray or writable memoryview) and returns the
+        number of bytes read, 0 at the end of the blob."""
+        data = self.read(len(buf))
+        memoryview(buf)[:len(data)] = data
+        return len(data)
+
+    def iter_chunks(self, chunk_size=READ_SIZE):
+        """Yields the rest of the blob in chunk_size pieces; only the last
+        one may be shorter."""
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def close(self):
+        self._response.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read_decoded(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self._response.read(READ_SIZE)
+            if data:
+                self._buffer += self._decompressor.decompress(data)
+            else:
+                flush = getattr(self._decompressor, "flush", None)
+                if flush is not None:
+                    self._buffer += flush()
+                self._eof = True
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+class BlobReader(object):
+    """Seekable read-only file-like object over a blob, for formats read
+    out of order such as zip archives. Reads are served from a cache of
+    block_size blocks filled by ranged GETs, so only the blocks actually
+    touched are downloaded. When a read moves on to the block after the
+    previous one, the next read_ahead blocks are fetched in the same
+    request. The blob is pinned to its ETag when opened: if it changes
+    meanwhile, reads fail with HTTPError 412. Blobs uploaded with a codec
+    cannot be read at random offsets and are refused with WAError."""
+
+    def __init__(self, blobs, container_name, blob_name,
+            block_size=READER_BLOCK_SIZE, read_ahead=4, cache_blocks=16):
+        if block_size < 1:
+            raise ValueError("block_size must be 1 or greater")
+        if cache_blocks < 1:
+            raise ValueError("cache_blocks must be 1 or greater")
+        self._blobs = blobs
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.cache_blocks = cache_blocks
+        properties = blobs.get_blob_properties(container_name, blob_name)
+        if CODEC_HEADER in properties:
+            raise WAError("%s/%s is compressed and cannot be read at random "
+                "offsets, use open_blob" % (container_name, blob_name))
+        self.length = int(properties["content-length"])
+        self.etag = properties.get("etag")
+        self.content_type = properties.get("content-type")
+        self.closed = False
+        self._position = 0
+        self._cache = OrderedDict()
+        # starting at the beginning counts as reading sequentially
+        self._last_block = -1
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        elif whence != os.SEEK_SET:
+            raise ValueError("invalid whence (%r)" % whence)
+        if offset < 0:
+            raise IOError("negative seek position %d" % offset)
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed BlobReader")
+        end = self.length
+        if size is not None and size >= 0:
+            end = min(end, self._position + size)
+        pieces = []
+        while self._position < end:
+            index, offset = divmod(self._position, self.block_size)
+            wanted = (end - 1) // self.block_size - index + 1
+            block = self._get_block(index, wanted)
+            piece = block[offset:offset + end - self._position]
+            pieces.append(piece)
+            self._position += len(piece)
+        return "".join(pieces)
+
+    def readinto(self, buf):
+        """Fills buf (a bytearray or writable memoryview) and returns the
+        number of bytes read, 0 at the end of the blob."""
+        data = self.read(len(buf))
+        memoryview(buf)[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._cache.clear()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_block(self, index, wanted):
+        """Returns block index, fetching it along with the following blocks
+        up to wanted in total, plus the read-ahead window when reading
+        sequentially, but never more than the cache holds."""
+        sequential = index == self._last_block + 1
+        self._last_block = index
+        if index in self._cache:
+            block = self._cache.pop(index)
+            self._cache[index] = block
+            return block
+        count = wanted + (self.read_ahead if sequential else 0)
+        block_count = (self.length + self.block_size - 1) // self.block_size
+        count = min(count, self.cache_blocks, block_count - index)
+        for n in xrange(1, count):
+            if index + n in self._cache:
+                count = n
+                break
+        start = index * self.block_size
+        end = min(start + count * self.block_size, self.length) - 1
+        data = self._blobs._open_blob_range(self.container_name,
+            self.blob_name, start, end, self.etag).read()
+        if len(data) != end + 1 - start:
+            raise WAError("Range %d-%d of %s/%s returned %d bytes" %
+                (start, end, self.container_name, self.blob_name, len(data)))
+        for n in xrange(count):
+            self._cache[index + n] = data[n * self.block_size:
+                                          (n + 1) * self.block_size]
+        while len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return self._cache[index]
+
 class BlobStorage(Storage):
     def __init__(self, host, account_name, secret_key,
             use_path_style_uris=None):
@@ -74,25 +493,193 @@ class BlobStorage(Storage):
             last_modified = time.strptime(container.find("LastModified").text, TIME_FORMAT)
             yield (container_name, etag, last_modified)
 
-    def list_blobs(self, container_name):
-        req = Request("%s/%s?comp=list" % (self.get_base_url(), container_name))
-        self._credentials.sign_request(req)
-        dom = etree.fromstring(urlopen(req).read())
-        containers = dom.findall(".//Blob")
-        for container in containers:
-            container_name = container.find("Name").text
-            etag = container.find("Etag").text
-            last_modified = time.strptime(container.find("LastModified").text, TIME_FORMAT)
-            yield (container_name, etag, last_modified)
+    def list_blobs(self, container_name, prefix=None, delimiter=None,
+            marker=None, maxresults=None, include_metadata=False):
+        """Lazily yields the container's blobs as Blob objects, following
+        continuation markers until the listing is complete.
 
-    def put_blob(self, container_name, blob_name, data, content_type = None):
-        req = RequestWithMethod("PUT", "%s/%s/%s" % (self.get_base_url(), container_name, blob_name), data=data)
-        req.add_header("Content-Length", "%d" % len(data))
+        Only blobs whose names start with prefix are listed. With a
+        delimiter, names containing it after the prefix are rolled up into
+        BlobPrefix entries. maxresults sets the page size (at most 5000).
+        Each page is parsed incrementally, so memory use does not grow with
+        the size of the container."""
+        while True:
+            request_string = "%s/%s?restype=container&comp=list" % (
+                self.get_base_url(), container_name)
+            if prefix:
+                request_string = add_url_parameter(request_string, "prefix",
+                                                   quote(prefix, safe=""))
+            if delimiter:
+                request_string = add_url_parameter(request_string,
+                    "delimiter", quote(delimiter, safe=""))
+            if marker:
+                request_string = add_url_parameter(request_string, "marker",
+                                                   quote(marker, safe=""))
+            if maxresults:
+                request_string = add_url_parameter(request_string,
+                                                   "maxresults", maxresults)
+            if include_metadata:
+                request_string = add_url_parameter(request_string, "include",
+                                                   "metadata")
+            req = Request(request_string)
+            req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
+            self._credentials.sign_request(req)
+            marker = None
+            # Tags of the open elements, so that metadata keys named like
+            # the listing's own elements are left to _parse_blob.
+            path = []
+            for event, element in etree.iterparse(urlopen(req),
+                    events=("start", "end")):
+                if event == "start":
+                    path.append(element.tag)
+                    if path[1:] == ["Blobs"]:
+                        blobs = element
+                    continue
+                path.pop()
+                if path[1:] == ["Blobs"]:
+                    if element.tag == "Blob":
+                        yield self._parse_blob(element)
+                        blobs.remove(element)
+                    elif element.tag == "BlobPrefix":
+                        yield BlobPrefix(element.findtext("Name"))
+                        blobs.remove(element)
+                elif len(path) == 1 and element.tag == "NextMarker":
+                    marker = element.text
+            if not marker:
+                return
+
+    def list_blobs_parallel(self, container_name, prefixes=None, delimiter="/",
+            depth=1, concurrency=DEFAULT_CONCURRENCY, ordered=False,
+            include_metadata=False, prefix=""):
+        """Lists disjoint prefixes of the container on concurrency threads and
+        merges their blobs into one stream of Blob objects.
+
+        When prefixes is None they are discovered by listing depth levels of
+        the delimiter hierarchy under prefix; blobs met on the way are
+        listed again in runs alongside them. Otherwise only blobs under the
+        given prefixes are listed, and none of them may start with another.
+        Blobs come out in name order if ordered is True, otherwise as soon
+        as they are listed."""
+        if prefixes is None:
+            units = self._split_listing(container_name, prefix, delimiter,
+                depth, concurrency, include_metadata)
+        else:
+            prefixes = sorted(set(prefixes))
+            for first, second in zip(prefixes, prefixes[1:]):
+                if second.startswith(first):
+                    raise ValueError("prefixes %r and %r overlap"
+                        % (first, second))
+            units = [BlobPrefix(p) for p in prefixes]
+
+        stop = threading.Event()
+        tasks = Queue.Queue()
+        merged = Queue.Queue(LIST_BATCHES_BUFFERED * concurrency)
+        outputs = []
+        for unit in units:
+            if ordered:
+                output = Queue.Queue(LIST_BATCHES_BUFFERED)
+            else:
+                output = merged
+            outputs.append(output)
+            tasks.put((unit, output))
+
+        def put(output, item):
+            while not stop.is_set():
+                try:
+                    output.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    unit, output = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    if isinstance(unit, BlobPrefix):
+                        blobs = self.list_blobs(container_name, unit.name,
+                            include_metadata=include_metadata)
+                    else:
+                        blobs = self._list_slice(container_name, unit,
+                            delimiter, include_metadata)
+                    batch = []
+                    for blob in blobs:
+                        batch.append(blob)
+                        if len(batch) == LIST_BATCH_SIZE:
+                            if not put(output, batch):
+                                return
+                            batch = []
+                    # None marks the end of the unit
+                    if not (put(output, batch) and put(output, None)):
+                        return
+                except Exception, e:
+                    put(output, e)
+
+        for _ in xrange(min(concurrency, len(units))):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+
+        def drain(output, units_left):
+            while units_left:
+                batch = output.get()
+                if batch is None:
+                    units_left -= 1
+                elif isinstance(batch, Exception):
+                    raise batch
+                else:
+                    for blob in batch:
+                        yield blob
+
+        try:
+            if ordered:
+                for output in outputs:
+                    for blob in drain(output, 1):
+                        yield blob
+            else:
+                for blob in drain(merged, len(units)):
+                    yield blob
+        finally:
+            stop.set()
+
+    def put_blob(self, container_name, blob_name, data, content_type = None,
+            block_size=MAX_BLOCK_SIZE, concurrency=DEFAULT_CONCURRENCY,
+            content_md5=None, codec=None):
+        """Uploads data as a block blob and returns the HTTP status code.
+
+        data may be a string, a bytearray, memoryview or mmap, a file-like
+        object (read from its current position) or an iterable of string
+        chunks. Data of known length within the single Put Blob limit is
+        streamed in one request; anything else is uploaded with
+        put_block_blob, using block_size and concurrency. content_md5, the
+        base64 MD5 of the whole blob, is stored with it when given.
+
+        codec, a Codec or the name of one in CODECS, compresses the blob as
+        it is uploaded, see put_block_blob. unicode data is sent encoded as
+        UTF-8."""
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        length = get_data_length(data)
+        if codec is not None or length is None or \
+                length > MAX_SINGLE_PUT_SIZE:
+            return self.put_block_blob(container_name, blob_name, data,
+                content_type, block_size, concurrency, content_md5,
+                codec=codec)
+        req = RequestWithMethod("PUT",
+            self._get_blob_url(container_name, blob_name), data=data)
+        req.add_header("Content-Length", "%d" % length)
+        req.add_header(PREFIX_STORAGE_HEADER + "blob-type", "BlockBlob")
         if content_type is not None:
             req.add_header("Content-Type", content_type)
         else:
             # urllib2 has dubious content-type meddling behaviour
             req.add_header("Content-Type", "")
+        if content_md5 is not None:
+            req.add_header("Content-MD5", content_md5)
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
         self._credentials.sign_request(req)
         try:
             response = urlopen(req)
@@ -100,13 +687,700 @@ class BlobStorage(Storage):
         except URLError, e:
             return e.code
 
-    def get_blob(self, container_name, blob_name):
-        req = Request("%s/%s/%s" % (self.get_base_url(), container_name, blob_name))
+    def put_block_blob(self, container_name, blob_name, data,
+            content_type=None, block_size=MAX_BLOCK_SIZE,
+            concurrency=DEFAULT_CONCURRENCY, content_md5=None,
+            journal=None, codec=None):
+        """Uploads data in blocks of block_size bytes, with up to concurrency
+        Put Block requests in flight, and commits them with Put Block List.
+        data is read a block at a time, see put_blob for the accepted types.
+        Returns the HTTP status code of the first failed request, or that of
+        Put Block List.
+
+        journal is the path of a BlockJournal file. Staged blocks are
+        recorded there, and a later call with the same journal skips the
+        blocks that the service still holds uncommitted. Block IDs carry the
+        MD5 of their data, so a block whose data changed is sent again. The
+        journal is removed once the blob is committed.
+
+        codec, a Codec or the name of one in CODECS, compresses data as it
+        is read, so blocks hold compressed bytes. The blob gets the codec's
+        Content-Encoding, the MD5 of the compressed bytes instead of
+        content_md5, and metadata naming the codec and the uncompressed size,
+        by which get_blob and open_blob decompress it."""
+        if not 0 < block_size <= MAX_BLOCK_SIZE:
+            raise ValueError("block_size must be between 1 and %d"
+                % MAX_BLOCK_SIZE)
+        encoder = None
+        if codec is not None:
+            data = encoder = _Encoder(get_codec(codec), data)
+        staged = set()
+        if journal is not None:
+            journal = BlockJournal(journal, container_name, blob_name,
+                block_size)
+            if journal.block_ids:
+                try:
+                    _, uncommitted = self.get_block_list(container_name,
+                        blob_name, "uncommitted")
+                except HTTPError, e:
+                    if e.code != 404:
+                        journal.close()
+                        raise
+                    uncommitted = []
+                staged = journal.block_ids.intersection(
+                    block_id for block_id, _ in uncommitted)
+
+        def find(block_id, size):
+            return block_id if block_id in staged else None
+
+        try:
+            code, block_list = self._put_blocks(container_name, blob_name,
+                data, block_size, concurrency, find, journal)
+        finally:
+            if journal is not None:
+                journal.close()
+        if code != 201:
+            return code
+        if encoder is None:
+            code = self.put_block_list(container_name, blob_name, block_list,
+                content_type, content_md5)
+        else:
+            code = self.put_block_list(container_name, blob_name, block_list,
+                content_type, encoder.content_md5,
+                encoder.codec.content_encoding, encoder.metadata)
+        if code == 201 and journal is not None:
+            journal.remove()
+        return code
+
+    def update_block_blob(self, container_name, blob_name, data,
+            content_type=None, block_size=MAX_BLOCK_SIZE,
+            concurrency=DEFAULT_CONCURRENCY, content_md5=None):
+        """Replaces the contents of a block blob, uploading only the blocks
+        that it does not already hold, and returns the HTTP status code like
+        put_block_blob.
+
+        data is split into blocks of block_size bytes. A block whose MD5 and
+        size match a committed block of the blob, as recorded in the block
+        IDs put_block_blob makes, is committed again by reference. So when
+        only a few blocks of a large blob change, only those are sent. A
+        blob that does not exist yet is uploaded in full."""
+        if not 0 < block_size <= MAX_BLOCK_SIZE:
+            raise ValueError("block_size must be between 1 and %d"
+                % MAX_BLOCK_SIZE)
+        try:
+            committed, _ = self.get_block_list(container_name, blob_name,
+                "committed")
+        except HTTPError, e:
+            if e.code != 404:
+                raise
+            committed = []
+        reusable = {}
+        for block_id, size in committed:
+            md5 = get_block_md5(block_id)
+            if md5 is not None:
+                reusable[(md5, size)] = (block_id, "Committed")
+
+        def find(block_id, size):
+            return reusable.get((get_block_md5(block_id), size))
+
+        code, block_list = self._put_blocks(container_name, blob_name, data,
+            block_size, concurrency, find)
+        if code != 201:
+            return code
+        log.debug("Updating %s/%s: %d of %d blocks reused", container_name,
+            blob_name, sum(1 for entry in block_list
+                           if isinstance(entry, tuple)), len(block_list))
+        return self.put_block_list(container_name, blob_name, block_list,
+            content_type, content_md5)
+
+    def put_block(self, container_name, blob_name, block_id, data):
+        """Uploads a block to be committed later by put_block_list. The block
+        is sent with its Content-MD5 so that the service verifies it."""
+        req = RequestWithMethod("PUT", "%s?comp=block&blockid=%s" % (
+            self._get_blob_url(container_name, blob_name),
+            quote(block_id, safe="")), data=data)
+        req.add_header("Content-Length", "%d" % len(data))
+        req.add_header("Content-MD5", base64.b64encode(
+            hashlib.md5(data).digest()))
+        req.add_header("Content-Type", "")
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
+        self._credentials.sign_request(req)
+        try:
+            response = urlopen(req)
+            return response.code
+        except HTTPError, e:
+            return e.code
+
+    def put_block_list(self, container_name, blob_name, block_ids,
+            content_type=None, content_md5=None, content_encoding=None,
+            metadata=None):
+        """Commits the blob from the given list of block IDs, in order. An
+        entry may also be a (block ID, list) pair, where list is 'Committed'
+        or 'Uncommitted', to say which block list to take the block from;
+        plain IDs take the latest block. metadata is a dict of the blob's
+        metadata names and values."""
+        entries = []
+        for block_id in block_ids:
+            block_list = "Latest"
+            if isinstance(block_id, tuple):
+                block_id, block_list = block_id
+            entries.append("<%s>%s</%s>" % (block_list, block_id, block_list))
+        data = '<?xml version="1.0" encoding="utf-8"?><BlockList>%s' \
+            '</BlockList>' % "".join(entries)
+        req = RequestWithMethod("PUT", "%s?comp=blocklist" %
+            self._get_blob_url(container_name, blob_name), data=data)
+        req.add_header("Content-Length", "%d" % len(data))
+        req.add_header("Content-Type", "")
+        if content_type is not None:
+            req.add_header(PREFIX_STORAGE_HEADER + "blob-content-type",
+                content_type)
+        if content_md5 is not None:
+            req.add_header(PREFIX_STORAGE_HEADER + "blob-content-md5",
+                content_md5)
+        if content_encoding is not None:
+            req.add_header(PREFIX_STORAGE_HEADER + "blob-content-encoding",
+                content_encoding)
+        for name, value in (metadata or {}).items():
+            req.add_header(PREFIX_STORAGE_HEADER + "meta-" + name, value)
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
         self._credentials.sign_request(req)
-        return urlopen(req).read()
+        try:
+            response = urlopen(req)
+            return response.code
+        except HTTPError, e:
+            return e.code
+
+    def get_block_list(self, container_name, blob_name, block_list_type="all"):
+        """Returns the (committed, uncommitted) lists of (block ID, size) of
+        the block blob. block_list_type may be 'all', 'committed' or
+        'uncommitted' to fetch only some of them."""
+        req = Request("%s?comp=blocklist&blocklisttype=%s" % (
+            self._get_blob_url(container_name, blob_name), block_list_type))
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
+        self._credentials.sign_request(req)
+        dom = etree.parse(urlopen(req))
+        return tuple([(block.findtext("Name"), int(block.findtext("Size")))
+                      for block in dom.findall(".//%s/Block" % blocks)]
+                     for blocks in ("CommittedBlocks", "UncommittedBlocks"))
+
+    def get_blob(self, container_name, blob_name, decode=True):
+        """Returns the contents of the blob, decompressed if it was uploaded
+        with a codec unless decode is false."""
+        req = Request(self._get_blob_url(container_name, blob_name))
+        self._credentials.sign_request(req)
+        response = urlopen(req)
+        codec = response.headers.get(CODEC_HEADER)
+        if not decode or not codec:
+            return response.read()
+        decompressor = get_codec(codec).decompressor()
+        data = decompressor.decompress(response.read())
+        flush = getattr(decompressor, "flush", None)
+        if flush is not None:
+            data += flush()
+        return data
     
+    def open_blob(self, container_name, blob_name, if_none_match=None,
+            decode=True):
+        """Returns a BlobStream reading the blob from a single request, for
+        processing its contents with constant memory. When if_none_match is
+        the blob's current ETag, HTTPError 304 is raised instead. Blobs
+        uploaded with a codec are decompressed unless decode is false."""
+        req = Request(self._get_blob_url(container_name, blob_name))
+        if if_none_match is not None:
+            req.add_header("If-None-Match", if_none_match)
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
+        self._credentials.sign_request(req)
+        return BlobStream(urlopen(req), decode)
+
+    def iter_blob(self, container_name, blob_name, chunk_size=READ_SIZE):
+        """Yields the blob in chunk_size pieces as they are received."""
+        with self.open_blob(container_name, blob_name) as stream:
+            for chunk in stream.iter_chunks(chunk_size):
+                yield chunk
+
+    def open_blob_reader(self, container_name, blob_name,
+            block_size=READER_BLOCK_SIZE, read_ahead=4, cache_blocks=16):
+        """Returns a seekable BlobReader over the blob."""
+        return BlobReader(self, container_name, blob_name, block_size,
+            read_ahead, cache_blocks)
+
+    def get_blob_properties(self, container_name, blob_name):
+        """Returns the blob's response headers (lower-cased names), which hold
+        its system properties and x-ms-meta- metadata."""
+        req = RequestWithMethod("HEAD",
+            self._get_blob_url(container_name, blob_name))
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
+        self._credentials.sign_request(req)
+        return dict(urlopen(req).headers.items())
+
+    def get_blob_range(self, container_name, blob_name, start, end):
+        """Returns the bytes from start to end (inclusive) of the blob.
+        Blobs uploaded with a codec are refused with WAError, as their
+        ranges hold compressed bytes."""
+        response = self._open_blob_range(container_name, blob_name, start,
+            end)
+        if response.headers.get(CODEC_HEADER):
+            response.close()
+            raise WAError("%s/%s is compressed and cannot be read in ranges, "
+                "use get_blob or open_blob" % (container_name, blob_name))
+        return response.read()
+
+    def get_blob_into(self, container_name, blob_name, target=None,
+            range_size=DOWNLOAD_RANGE_SIZE, concurrency=DEFAULT_CONCURRENCY):
+        """Downloads the blob with up to concurrency ranged requests in
+        flight, writing each range straight to its offset in target.
+
+        target may be a bytearray at least as long as the blob or a file
+        opened for writing; when it is None a bytearray of the blob's length
+        is allocated. Returns target.
+
+        A blob uploaded with a codec is downloaded in a single request and
+        decompressed into target instead, its length being the uncompressed
+        size."""
+        properties = self.get_blob_properties(container_name, blob_name)
+        if CODEC_HEADER in properties:
+            return self._get_decoded_into(container_name, blob_name,
+                int(properties[SIZE_HEADER]), target)
+        length = int(properties["content-length"])
+        if target is None:
+            target = bytearray(length)
+        self._get_ranges_into(container_name, blob_name, length,
+            [(0, length - 1)] if length else [], target, range_size,
+            concurrency, properties.get("etag"))
+        return target
+
+    def create_page_blob(self, container_name, blob_name, size,
+            content_type=None):
+        """Creates an empty page blob of size bytes, a multiple of 512."""
+        req = RequestWithMethod("PUT",
+            self._get_blob_url(container_name, blob_name))
+        req.add_header("Content-Length", "0")
+        req.add_header("Content-Type", "")
+        req.add_header(PREFIX_STORAGE_HEADER + "blob-type", "PageBlob")
+        req.add_header(PREFIX_STORAGE_HEADER + "blob-content-length",
+            "%d" % size)
+        if content_type is not None:
+            req.add_header(PREFIX_STORAGE_HEADER + "blob-content-type",
+                content_type)
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
+        self._credentials.sign_request(req)
+        try:
+            response = urlopen(req)
+            return response.code
+        except HTTPError, e:
+            return e.code
+
+    def put_page(self, container_name, blob_name, start, data):
+        """Writes data, whose length is a multiple of 512, to the page blob
+        at offset start, also a multiple of 512."""
+        req = RequestWithMethod("PUT", "%s?comp=page" %
+            self._get_blob_url(container_name, blob_name), data=data)
+        req.add_header("Content-Length", "%d" % len(data))
+        req.add_header("Content-MD5", base64.b64encode(
+            hashlib.md5(data).digest()))
+        req.add_header("Content-Type", "")
+        req.add_header(PREFIX_STORAGE_HEADER + "page-write", "update")
+        req.add_header(PREFIX_STORAGE_HEADER + "range",
+            "bytes=%d-%d" % (start, start + len(data) - 1))
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
+        self._credentials.sign_request(req)
+        try:
+            response = urlopen(req)
+            return response.code
+        except HTTPError, e:
+            return e.code
+
+    def get_page_ranges(self, container_name, blob_name):
+        """Returns the (start, end) byte ranges, end inclusive, of the pages
+        of the page blob that hold data."""
+        req = Request("%s?comp=pagelist" %
+            self._get_blob_url(container_name, blob_name))
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
+        self._credentials.sign_request(req)
+        dom = etree.parse(urlopen(req))
+        return [(int(r.findtext("Start")), int(r.findtext("End")))
+                for r in dom.findall(".//PageRange")]
+
+    def put_page_blob(self, container_name, blob_name, data,
+            content_type=None, concurrency=DEFAULT_CONCURRENCY):
+        """Uploads data as a page blob, sending only the pages that are not
+        all zeros, and returns the HTTP status code of the first failed
+        request or 201.
+
+        data is read a chunk at a time like in put_blob, but its length must
+        be known and be a multiple of 512. Pages never written read back as
+        zeros, so sparse disk images upload only their populated regions."""
+        length = get_data_length(data)
+        if length is None or length % PAGE_SIZE:
+            raise ValueError("page blob data length must be a known multiple"
+                " of %d" % PAGE_SIZE)
+        code = self.create_page_blob(container_name, blob_name, length,
+            content_type)
+        if code != 201:
+            return code
+
+        def writes():
+            offset = 0
+            for chunk in iter_chunks(data, MAX_PAGE_WRITE_SIZE):
+                if isinstance(chunk, memoryview):
+                    chunk = chunk.tobytes()
+                if chunk.count("\0") != len(chunk):
+                    run = None
+                    for page in xrange(0, len(chunk), PAGE_SIZE):
+                        if chunk[page:page + PAGE_SIZE] == ZERO_PAGE:
+                            if run is not None:
+                                yield offset + run, chunk[run:page]
+                                run = None
+                        elif run is None:
+                            run = page
+                    if run is not None:
+                        yield offset + run, chunk[run:]
+                offset += len(chunk)
+
+        put = lambda write: self.put_page(container_name, blob_name, *write)
+        for _, code, error in parallel_imap(put, writes(), concurrency):
+            if error is not None:
+                raise error
+            if code != 201:
+                return code
+        return 201
+
+    def get_page_blob_into(self, container_name, blob_name, target=None,
+            range_size=DOWNLOAD_RANGE_SIZE, concurrency=DEFAULT_CONCURRENCY):
+        """Downloads a page blob like get_blob_into, fetching only the ranges
+        listed by get_page_ranges. The rest of target is left alone, so it
+        should start out zeroed; a file is extended to the blob's length.
+        Returns target."""
+        properties = self.get_blob_properties(container_name, blob_name)
+        length = int(properties["content-length"])
+        if target is None:
+            target = bytearray(length)
+        elif not isinstance(target, bytearray):
+            target.truncate(length)
+        self._get_ranges_into(container_name, blob_name, length,
+            self.get_page_ranges(container_name, blob_name), target,
+            range_size, concurrency, properties.get("etag"))
+        return target
+
     def delete_blob(self, container_name, blob_name):
-        req = Request("DELETE", "%s/%s/%s" % (self.get_base_url(), container_name,
-                      blob_name))
+        """Deletes the blob and returns the HTTP status code. Errors that
+        carry no status code, such as failed connections, are raised."""
+        req = RequestWithMethod("DELETE",
+            self._get_blob_url(container_name, blob_name))
+        self._credentials.sign_request(req)
+        try:
+            response = urlopen(req)
+            return response.code
+        except HTTPError, e:
+            return e.code
+
+    def delete_blobs(self, container_name, blob_names=None, prefix=None,
+            predicate=None, concurrency=DEFAULT_CONCURRENCY, progress=None):
+        """Deletes many blobs with up to concurrency requests in flight and
+        returns a BulkResult.
+
+        The blobs are blob_names if given, otherwise the listing of the blobs
+        under prefix, which is consumed as deletes progress. One of them must
+        be given; deleting every blob of the container takes prefix="".
+        predicate, if given, is called with each name or listed Blob and
+        only those it returns True for are deleted. Blobs that are already
+        gone count as deleted. progress, if given, is called with the
+        BulkResult after each blob. Failures are recorded in the result and
+        do not stop the run."""
+        if blob_names is None and prefix is None:
+            raise ValueError("blob_names or prefix must be given")
+        if blob_names is None:
+            entries = self.list_blobs(container_name, prefix)
+        else:
+            entries = blob_names
+        if predicate is not None:
+            entries = (entry for entry in entries if predicate(entry))
+        names = (getattr(entry, "name", entry) for entry in entries)
+        delete = lambda name: self.delete_blob(container_name, name)
+        result = BulkResult()
+        for name, code, error in parallel_imap(delete, names, concurrency):
+            if error is None and code not in (202, 404):
+                error = code
+            result.add(name, error)
+            if progress is not None:
+                progress(result)
+        result.finish()
+        return result
+
+    def copy_blob(self, container_name, blob_name, source_container,
+            source_blob, source=None):
+        """Copies a blob server-side and returns the HTTP status code.
+
+        The source blob is read from the source BlobStorage, this account by
+        default; a blob of another account must be publicly readable. The
+        copy may still be pending when this returns, see get_copy_status."""
+        return self._copy_blob(container_name, blob_name, source_container,
+            source_blob, source)[0]
+
+    def get_copy_status(self, container_name, blob_name):
+        """Returns the (status, progress) of the last copy into the blob,
+        status being 'pending', 'success', 'aborted' or 'failed' and progress
+        a 'copied/total' bytes string, or (None, None) if it never was the
+        destination of a copy."""
+        properties = self.get_blob_properties(container_name, blob_name)
+        return (properties.get(PREFIX_STORAGE_HEADER + "copy-status"),
+                properties.get(PREFIX_STORAGE_HEADER + "copy-progress"))
+
+    def copy_blobs(self, container_name, source_container, prefix=None,
+            blob_names=None, source=None, concurrency=DEFAULT_CONCURRENCY,
+            poll_interval=2, progress=None):
+        """Copies blobs server-side into container_name, keeping their names,
+        and returns a BulkResult once every copy has completed.
+
+        The blobs are blob_names if given, otherwise the listing of the
+        blobs under prefix in source_container of source (see copy_blob).
+        Copies are started with up to concurrency requests in flight, then
+        those the service reports as pending are polled every poll_interval
+        seconds. progress, if given, is called with the BulkResult after
+        each blob completes."""
+        if blob_names is None:
+            blob_names = (blob.name for blob in (source or self).list_blobs(
+                source_container, prefix))
+        result = BulkResult()
+
+        def done(name, error=None):
+            result.add(name, error)
+            if progress is not None:
+                progress(result)
+
+        start = lambda name: self._copy_blob(container_name, name,
+            source_container, name, source)
+        pending = []
+        for name, response, error in parallel_imap(start, blob_names,
+                concurrency):
+            if error is None:
+                code, status = response
+                if code not in (201, 202):
+                    error = code
+                elif status == "pending":
+                    pending.append(name)
+                    continue
+            done(name, error)
+
+        poll = lambda name: self.get_copy_status(container_name, name)[0]
+        while pending:
+            time.sleep(poll_interval)
+            still_pending = []
+            for name, status, error in parallel_imap(poll, pending,
+                    concurrency):
+                if error is None:
+                    if status == "pending":
+                        still_pending.append(name)
+                        continue
+                    if status is None:
+                        error = WAError("No copy status for %s/%s"
+                            % (container_name, name))
+                    elif status != "success":
+                        error = status
+                done(name, error)
+            pending = still_pending
+        result.finish()
+        return result
+
+    def _copy_blob(self, container_name, blob_name, source_container,
+            source_blob, source):
+        """Starts a copy and returns the HTTP status code and the copy status
+        reported with it."""
+        source_url = (source or self)._get_blob_url(source_container,
+            source_blob)
+        req = RequestWithMethod("PUT",
+            self._get_blob_url(container_name, blob_name))
+        req.add_header("Content-Length", "0")
+        req.add_header("Content-Type", "")
+        req.add_header(PREFIX_STORAGE_HEADER + "copy-source", source_url)
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
+        self._credentials.sign_request(req)
+        try:
+            response = urlopen(req)
+        except HTTPError, e:
+            return e.code, None
+        return response.code, response.headers.getheader(
+            PREFIX_STORAGE_HEADER + "copy-status")
+
+    def _split_listing(self, container_name, prefix, delimiter, depth,
+            concurrency, include_metadata):
+        """Expands the delimiter hierarchy under prefix depth levels down and
+        returns the result in name order: BlobPrefix entries still to be
+        listed, and _LevelSlice entries for the runs of blobs found along
+        the way. Only the prefixes are kept from the discovery listings;
+        the blobs are listed again by the workers, so they are never held
+        in memory."""
+        def expand(unit):
+            if not isinstance(unit, BlobPrefix):
+                return [unit]
+            entries = []
+            after = None
+            has_blobs = False
+            for entry in self.list_blobs(container_name, unit.name,
+                    delimiter):
+                if isinstance(entry, BlobPrefix):
+                    if has_blobs:
+                        entries.append(_LevelSlice(unit.name, after,
+                            entry.name))
+                        has_blobs = False
+                    entries.append(entry)
+                    after = entry.name
+                else:
+                    has_blobs = True
+            if has_blobs:
+                entries.append(_LevelSlice(unit.name, after, None))
+            return entries
+
+        units = [BlobPrefix(prefix)]
+        for _ in xrange(depth):
+            expanded = []
+            for _, entries, error in parallel_imap(expand, units,
+                    concurrency, ordered=True):
+                if error is not None:
+                    raise error
+                expanded.extend(entries)
+            units = expanded
+        return units
+
+    def _list_slice(self, container_name, level_slice, delimiter,
+            include_metadata):
+        after, before = level_slice.after, level_slice.before
+        for entry in self.list_blobs(container_name, level_slice.prefix,
+                delimiter, include_metadata=include_metadata):
+            if isinstance(entry, BlobPrefix):
+                continue
+            if after is not None and entry.name < after:
+                continue
+            if before is not None and entry.name > before:
+                return
+            yield entry
+
+    def _parse_blob(self, element):
+        properties = element.find("Properties")
+        metadata = element.find("Metadata")
+        if metadata is not None:
+            metadata = dict((m.tag, m.text) for m in metadata)
+        return Blob(element.findtext("Name"),
+                    properties.findtext("Etag"),
+                    properties.findtext("Last-Modified"),
+                    int(properties.findtext("Content-Length")),
+                    properties.findtext("Content-Type") or None,
+                    properties.findtext("Content-Encoding") or None,
+                    properties.findtext("Content-MD5") or None,
+                    properties.findtext("BlobType"),
+                    metadata)
+
+    def _get_blob_url(self, container_name, blob_name):
+        if isinstance(blob_name, unicode):
+            blob_name = blob_name.encode("utf-8")
+        return "%s/%s/%s" % (self.get_base_url(), container_name,
+                             quote(blob_name))
+
+    def _put_blocks(self, container_name, blob_name, data, block_size,
+            concurrency, find_block, journal=None):
+        """Stages data a block at a time and returns the HTTP status code of
+        the first failed Put Block, or 201 and the block list to commit.
+
+        find_block is called with each block's ID and size, and returns the
+        block list entry of an existing block to use instead of uploading
+        it, or None. Staged blocks are recorded in journal if given."""
+        def put(block):
+            index, chunk = block
+            block_id = make_block_id(index, chunk)
+            entry = find_block(block_id, len(chunk))
+            if entry is not None:
+                return entry, 201
+            code = self.put_block(container_name, blob_name, block_id, chunk)
+            if code == 201 and journal is not None:
+                journal.record(block_id)
+            return block_id, code
+
+        block_list = []
+        for _, result, error in parallel_imap(put,
+                enumerate(iter_chunks(data, block_size)), concurrency,
+                ordered=True):
+            if error is not None:
+                raise error
+            entry, code = result
+            if code != 201:
+                return code, None
+            block_list.append(entry)
+        return 201, block_list
+
+    def _get_ranges_into(self, container_name, blob_name, length, ranges,
+            target, range_size, concurrency, etag=None):
+        """Fetches the (start, end) byte ranges of the blob, in pieces of at
+        most range_size bytes, and writes them to their offsets in target,
+        a bytearray or a file. Given the etag, every range is requested
+        with If-Match so a blob replaced midway fails instead of mixing
+        two versions."""
+        if range_size < 1:
+            raise ValueError("range_size must be 1 or greater")
+        if isinstance(target, bytearray):
+            if len(target) < length:
+                raise ValueError("target is smaller than the blob (%d bytes)"
+                    % length)
+            view = memoryview(target)
+            def write(offset, data):
+                view[offset:offset + len(data)] = data
+        else:
+            lock = threading.Lock()
+            def write(offset, data):
+                with lock:
+                    target.seek(offset)
+                    target.write(data)
+
+        def fetch(piece):
+            start, end = piece
+            response = self._open_blob_range(container_name, blob_name,
+                start, end, etag)
+            offset = start
+            while offset <= end:
+                data = response.read(min(READ_SIZE, end + 1 - offset))
+                if not data:
+                    raise WAError("Range %d-%d of %s/%s ended at %d" %
+                        (start, end, container_name, blob_name, offset))
+                write(offset, data)
+                offset += len(data)
+
+        pieces = ((start, min(start + range_size, end + 1) - 1)
+                  for first, end in ranges
+                  for start in xrange(first, end + 1, range_size))
+        for _, _, error in parallel_imap(fetch, pieces, concurrency):
+            if error is not None:
+                raise error
+
+    def _get_decoded_into(self, container_name, blob_name, length, target):
+        """Streams the decompressed blob to the start of target, a bytearray
+        or a file."""
+        if target is None:
+            target = bytearray(length)
+        elif isinstance(target, bytearray):
+            if len(target) < length:
+                raise ValueError("target is smaller than the blob (%d bytes)"
+                    % length)
+        else:
+            target.seek(0)
+        offset = 0
+        with self.open_blob(container_name, blob_name) as stream:
+            for chunk in stream.iter_chunks():
+                if isinstance(target, bytearray):
+                    target[offset:offset + len(chunk)] = chunk
+                else:
+                    target.write(chunk)
+                offset += len(chunk)
+        if offset != length:
+            raise WAError("%s/%s decompressed to %d bytes instead of %d" %
+                (container_name, blob_name, offset, length))
+        return target
+
+    def _open_blob_range(self, container_name, blob_name, start, end,
+            if_match=None):
+        req = Request(self._get_blob_url(container_name, blob_name))
+        req.add_header(PREFIX_STORAGE_HEADER + "range",
+            "bytes=%d-%d" % (start, end))
+        if if_match is not None:
+            req.add_header("If-Match", if_match)
+        req.add_header(STORAGE_VERSION_HEADER, STORAGE_VERSION)
         self._credentials.sign_request(req)
-        return urlopen(req).read()
+        return urlopen(req)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Python wrapper around Windows Azure storage and management APIs
+
+Authors:
+    Sriram Krishnan <sriramk@microsoft.com>
+    Steve Marx <steve.marx@microsoft.com>
+    Tihomir Petkov <tpetkov@gmail.com>
+
+License:
+    GNU General Public Licence (GPL)
+    
+    This file is part of pyazure.
+    
+    pyazure is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pyazure is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with pyazure. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib2 import HTTPError
+
+from util import *
+
+class BlobDiskCache(object):
+    """Read-through cache of blobs on local disk, safe to share between the
+    processes of a host.
+
+    Entries are keyed by account, container and blob name. Every read is
+    revalidated with If-None-Match against the cached ETag, so an unchanged
+    blob costs a 304 response rather than a download. Entries are replaced
+    with atomic renames and the least recently used ones are evicted once
+    the cache grows past max_size bytes."""
+
+    # cached files older than this are left-overs of interrupted writes
+    STALE_PARTIAL_AGE = 3600
+
+    def __init__(self, blobs, cache_dir, max_size=1024 * 1024 * 1024):
+        self._blobs = blobs
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def get(self, container_name, blob_name):
+        """Returns the blob's contents like BlobStorage.get_blob."""
+        with self.open(container_name, blob_name) as f:
+            return f.read()
+
+    def open(self, container_name, blob_name):
+        """Returns the cached copy of the blob as a file positioned at the
+        start of its contents, refreshing it first if the blob changed."""
+        path = self._get_path(container_name, blob_name)
+        try:
+            cached = open(path, "rb")
+        except IOError:
+            cached = None
+        try:
+            etag = cached.readline().rstrip("\n") if cached else None
+            try:
+                stream = self._blobs.open_blob(container_name, blob_name,
+                                               if_none_match=etag)
+            except HTTPError, e:
+                if e.code == 304 and cached:
+                    self._touch(path)
+                    result, cached = cached, None
+                    return result
+                if e.code == 404:
+                    self._remove(path)
+                raise
+        finally:
+            if cached:
+                cached.close()
+        with stream:
+            cached = self._store(path, stream)
+        self._evict()
+        return cached
+
+    def _store(self, path, stream):
+        """Writes the stream to the entry at path and returns the new entry
+        opened at the start of the blob's contents, which stays readable
+        even if the entry is replaced or evicted meanwhile."""
+        fd, partial = tempfile.mkstemp(prefix=".", dir=self.cache_dir)
+        f = os.fdopen(fd, "w+b")
+        try:
+            f.write(stream.etag + "\n")
+            for chunk in stream.iter_chunks():
+                f.write(chunk)
+            f.flush()
+            f.seek(len(stream.etag) + 1)
+            try:
+                os.rename(partial, path)
+            except OSError:
+                # Windows does not rename over existing files
+                self._remove(path)
+                os.rename(partial, path)
+        except:
+            f.close()
+            self._remove(partial)
+            raise
+        return f
+
+    def _evict(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith("."):
+                if now - stat.st_mtime > self.STALE_PARTIAL_AGE:
+                    self._remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    def _get_path(self, container_name, blob_name):
+        key = "%s/%s/%s" % (self._blobs.get_base_url(), container_name,
+                            blob_name)
+        return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest())
+
+    def _touch(self, path):
+        # the modification time is what eviction orders entries by
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+class _Flight(object):
+    """Request in progress, whose outcome is shared by the threads that
+    asked for the same blob meanwhile."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def finish(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+class BlobMemoryCache(object):
+    """In-process LRU cache for small, frequently read blobs, holding at most
+    max_bytes of blob contents.
+
+    Entries younger than ttl seconds are served without contacting the
+    service; older ones are revalidated with If-None-Match. Concurrent
+    misses for the same blob are coalesced into a single request whose
+    result, or exception, all the callers share."""
+
+    def __init__(self, blobs, max_bytes=64 * 1024 * 1024, ttl=30):
+        self._blobs = blobs
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # (container_name, blob_name) -> (data, etag, time fetched), least
+        # recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, container_name, blob_name):
+        """Returns the blob's contents like BlobStorage.get_blob."""
+        key = (container_name, blob_name)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                if time.time() - entry[2] < self.ttl:
+                    return entry[0]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            return flight.wait()
+        try:
+            data = self._fetch(key, entry)
+        except Exception, e:
+            flight.finish(error=e)
+            raise
+        else:
+            flight.finish(data)
+            return data
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+    def invalidate(self, container_name, blob_name):
+        """Drops the blob from the cache."""
+        with self._lock:
+            self._discard((container_name, blob_name))
+
+    def _fetch(self, key, entry):
+        container_name, blob_name = key
+        etag = entry[1] if entry else None
+        try:
+            with self._blobs.open_blob(container_name, blob_name,
+                                       if_none_match=etag) as stream:
+                data = stream.read()
+                etag = stream.etag
+        except HTTPError, e:
+            with self._lock:
+                if e.code == 304 and entry:
+                    if key in self._entries:
+                        self._entries[key] = (entry[0], entry[1], time.time())
+                    return entry[0]
+                self._discard(key)
+            raise
+        with self._lock:
+            self._discard(key)
+            if len(data) <= self.max_bytes:
+                self._entries[key] = (data, etag, time.time())
+                self._size += len(data)
+                while self._size > self.max_bytes:
+                    _, (evicted, _, _) = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return data
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
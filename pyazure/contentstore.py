@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Python wrapper around Windows Azure storage and management APIs
+
+Authors:
+    Sriram Krishnan <sriramk@microsoft.com>
+    Steve Marx <steve.marx@microsoft.com>
+    Tihomir Petkov <tpetkov@gmail.com>
+
+License:
+    GNU General Public Licence (GPL)
+    
+    This file is part of pyazure.
+    
+    pyazure is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pyazure is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with pyazure. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import base64
+import hashlib
+import tempfile
+import threading
+from urllib2 import HTTPError
+
+from util import *
+from blob import READ_SIZE
+
+class ContentStore(object):
+    """Content-addressed store over a container.
+
+    Contents are stored once, as blobs named by their SHA-256 under
+    objects_prefix; storing contents that are already there sends nothing
+    but a HEAD request, or no request at all once the digest is known from
+    an earlier call or from load_manifest. Logical names are pointer blobs
+    under refs_prefix whose contents are the digest they resolve to."""
+
+    def __init__(self, blobs, container_name, objects_prefix="objects/",
+            refs_prefix="refs/", spool_size=16 * 1024 * 1024):
+        self._blobs = blobs
+        self.container_name = container_name
+        self.objects_prefix = objects_prefix
+        self.refs_prefix = refs_prefix
+        # streams that cannot be read twice are spooled while being hashed,
+        # in memory up to spool_size bytes and on disk beyond
+        self.spool_size = spool_size
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def put(self, name, data, content_type=None):
+        """Stores data, which may be anything put_blob accepts, unless it is
+        already stored, points name at it and returns its digest."""
+        digest = self.put_object(data, content_type)
+        code = self._blobs.put_blob(self.container_name,
+            self.refs_prefix + name, digest, "text/plain")
+        if code != 201:
+            raise WAError("Put Blob of reference %s returned %d"
+                % (name, code))
+        return digest
+
+    def put_object(self, data, content_type=None):
+        """Stores data unless it is already stored and returns its digest."""
+        digest, md5, source = self._hash(data)
+        try:
+            if not self.contains(digest):
+                code = self._blobs.put_blob(self.container_name,
+                    self.objects_prefix + digest, source, content_type,
+                    content_md5=md5)
+                if code != 201:
+                    raise WAError("Put Blob of object %s returned %d"
+                        % (digest, code))
+                with self._lock:
+                    self._known.add(digest)
+        finally:
+            if source is not data:
+                source.close()
+        return digest
+
+    def contains(self, digest):
+        """Tells whether contents with this digest are stored."""
+        with self._lock:
+            if digest in self._known:
+                return True
+        try:
+            self._blobs.get_blob_properties(self.container_name,
+                self.objects_prefix + digest)
+        except HTTPError, e:
+            if e.code == 404:
+                return False
+            raise
+        with self._lock:
+            self._known.add(digest)
+        return True
+
+    def load_manifest(self):
+        """Lists the stored objects once so that contains needs no request
+        for them."""
+        digests = [blob.name[len(self.objects_prefix):] for blob in
+                   self._blobs.list_blobs(self.container_name,
+                                          self.objects_prefix)]
+        with self._lock:
+            self._known.update(digests)
+
+    def resolve(self, name):
+        """Returns the digest name points at."""
+        return self._blobs.get_blob(self.container_name,
+            self.refs_prefix + name).strip()
+
+    def get(self, name):
+        """Returns the contents name points at."""
+        return self.get_object(self.resolve(name))
+
+    def get_object(self, digest):
+        return self._blobs.get_blob(self.container_name,
+            self.objects_prefix + digest)
+
+    def open(self, name):
+        """Returns a BlobStream over the contents name points at."""
+        return self._blobs.open_blob(self.container_name,
+            self.objects_prefix + self.resolve(name))
+
+    def delete(self, name):
+        """Removes the name; the contents stay, as other names may share
+        them. Returns the HTTP status code."""
+        return self._blobs.delete_blob(self.container_name,
+            self.refs_prefix + name)
+
+    def _hash(self, data):
+        """Returns the hex SHA-256 and base64 MD5 of data, and data itself
+        or, if it could not be read twice, a spooled copy of it."""
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        if isinstance(data, (str, bytearray, memoryview, buffer)):
+            sha256.update(data)
+            md5.update(data)
+        elif hasattr(data, "read") and get_data_length(data) is not None:
+            position = data.tell()
+            for chunk in iter_chunks(data, READ_SIZE):
+                sha256.update(chunk)
+                md5.update(chunk)
+            data.seek(position)
+        else:
+            spool = tempfile.SpooledTemporaryFile(self.spool_size)
+            for chunk in iter_chunks(data, READ_SIZE):
+                sha256.update(chunk)
+                md5.update(chunk)
+                spool.write(chunk)
+            spool.seek(0)
+            data = spool
+        return sha256.hexdigest(), base64.b64encode(md5.digest()), data
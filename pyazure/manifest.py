@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Python wrapper around Windows Azure storage and management APIs
+
+Authors:
+    Sriram Krishnan <sriramk@microsoft.com>
+    Steve Marx <steve.marx@microsoft.com>
+    Tihomir Petkov <tpetkov@gmail.com>
+
+License:
+    GNU General Public Licence (GPL)
+    
+    This file is part of pyazure.
+    
+    pyazure is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pyazure is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with pyazure. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import calendar
+import json
+import sqlite3
+import time
+
+from util import *
+from blob import Blob
+
+# Rows written per executemany while refreshing
+REFRESH_BATCH_SIZE = 1000
+
+class BlobManifest(object):
+    """Local SQLite index of a container's listing, so that questions about
+    its contents are answered without listing it again.
+
+    refresh lists the container (or part of it) once and brings the index up
+    to date in a single transaction. The query methods then read only the
+    index. Names are the primary key, so prefix and name range queries
+    use its index. Last-modified times are stored as seconds since the
+    epoch for changed_since. A manifest must be used from the thread that
+    opened it."""
+
+    def __init__(self, blobs, container_name, path):
+        self._blobs = blobs
+        self.container_name = container_name
+        self.path = path
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS blobs ("
+                "name TEXT PRIMARY KEY, size INTEGER, etag TEXT, "
+                "last_modified TEXT, modified REAL, content_type TEXT, "
+                "content_md5 TEXT, blob_type TEXT, metadata TEXT, "
+                "generation INTEGER)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS blobs_modified "
+                "ON blobs (modified)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS state ("
+                "key TEXT PRIMARY KEY, value)")
+
+    def refresh(self, prefix="", concurrency=1, delimiter="/", depth=1):
+        """Lists the blobs whose names start with prefix and replaces the
+        indexed entries under prefix with them. Returns the numbers of blobs
+        listed and of entries removed because their blobs are gone.
+
+        With concurrency greater than one, the listing is split along depth
+        levels of the delimiter hierarchy under prefix and the parts are
+        listed on concurrency threads."""
+        if concurrency > 1:
+            listing = self._blobs.list_blobs_parallel(self.container_name,
+                delimiter=delimiter, depth=depth, concurrency=concurrency,
+                include_metadata=True, prefix=prefix)
+        else:
+            listing = self._blobs.list_blobs(self.container_name,
+                prefix or None, include_metadata=True)
+        with self._db:
+            generation = (self._get_state("generation") or 0) + 1
+            self._set_state("generation", generation)
+            listed = 0
+            batch = []
+            for blob in listing:
+                batch.append(self._to_row(blob, generation))
+                if len(batch) == REFRESH_BATCH_SIZE:
+                    listed += self._write(batch)
+                    batch = []
+            listed += self._write(batch)
+            where, args = self._prefix_clause(prefix)
+            removed = self._db.execute("DELETE FROM blobs WHERE generation < ?"
+                " AND " + where, [generation] + args).rowcount
+            self._set_state("refreshed", time.time())
+        return listed, removed
+
+    @property
+    def refreshed(self):
+        """Time of the last refresh in seconds since the epoch, or None."""
+        return self._get_state("refreshed")
+
+    def get(self, name):
+        """Returns the indexed Blob of that name, or None."""
+        return next(self._query("name = ?", [name]), None)
+
+    def list(self, prefix="", start=None, end=None, limit=None):
+        """Yields the indexed blobs under prefix in name order, optionally
+        only those with names from start up to, but excluding, end."""
+        where, args = self._prefix_clause(prefix)
+        if start is not None:
+            where += " AND name >= ?"
+            args.append(start)
+        if end is not None:
+            where += " AND name < ?"
+            args.append(end)
+        return self._query(where, args, limit)
+
+    def count(self, prefix=""):
+        where, args = self._prefix_clause(prefix)
+        return self._db.execute("SELECT COUNT(*) FROM blobs WHERE " + where,
+            args).fetchone()[0]
+
+    def total_size(self, prefix=""):
+        """Returns the total size in bytes of the blobs under prefix."""
+        where, args = self._prefix_clause(prefix)
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs "
+            "WHERE " + where, args).fetchone()[0]
+
+    def changed_since(self, timestamp, prefix=""):
+        """Yields the blobs under prefix last modified at or after timestamp
+        (seconds since the epoch), oldest first."""
+        where, args = self._prefix_clause(prefix)
+        return self._query(where + " AND modified >= ?", args + [timestamp],
+            order="modified, name")
+
+    def match(self, pattern):
+        """Yields the blobs whose names match the shell-style pattern, in
+        which * and ? also match /."""
+        return self._query("name GLOB ?", [pattern])
+
+    def close(self):
+        self._db.close()
+
+    def _query(self, where, args, limit=None, order="name"):
+        sql = "SELECT name, etag, last_modified, size, content_type, " \
+              "content_md5, blob_type, metadata FROM blobs WHERE %s " \
+              "ORDER BY %s" % (where, order)
+        if limit is not None:
+            sql += " LIMIT %d" % limit
+        for (name, etag, last_modified, size, content_type, content_md5,
+                blob_type, metadata) in self._db.execute(sql, args):
+            yield Blob(name, etag, last_modified, size, content_type, None,
+                       content_md5, blob_type,
+                       json.loads(metadata) if metadata else None)
+
+    def _prefix_clause(self, prefix):
+        """Returns a WHERE clause and its arguments selecting the names
+        starting with prefix as a range of the primary key."""
+        if not prefix:
+            return "1", []
+        prefix = unicode(prefix)
+        return "name >= ? AND name < ?", \
+            [prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)]
+
+    def _to_row(self, blob, generation):
+        modified = None
+        if blob.last_modified:
+            modified = calendar.timegm(time.strptime(blob.last_modified,
+                                                     TIME_FORMAT))
+        return (blob.name, blob.size, blob.etag, blob.last_modified,
+                modified, blob.content_type, blob.content_md5, blob.blob_type,
+                json.dumps(blob.metadata) if blob.metadata else None,
+                generation)
+
+    def _write(self, rows):
+        self._db.executemany("INSERT OR REPLACE INTO blobs VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def _get_state(self, key):
+        row = self._db.execute("SELECT value FROM state WHERE key = ?",
+            [key]).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO state VALUES (?, ?)",
+            [key, value])
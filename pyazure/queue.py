@@ -29,7 +29,17 @@ License:
 """
 
 import base64
+import errno
+import httplib
+import json
+import random
+import socket
+import struct
+import threading
 import time
+import zlib
+from xml.sax.saxutils import escape
+from collections import deque
 try:
     from lxml import etree
 except ImportError:
@@ -38,7 +48,169 @@ from urllib2 import Request, urlopen, URLError
 
 from util import *
 
-class QueueMessage(): pass
+# Most messages a single Get Messages request returns
+MAX_MESSAGES_PER_GET = 32
+# Requests put_messages keeps in flight by default
+DEFAULT_CONCURRENCY = 8
+# Seconds put_messages waits on a connection before giving up on it
+CONNECTION_TIMEOUT = 60
+# Seconds a consumer waits before polling again when its poller raises
+POLLER_ERROR_DELAY = 1.0
+# Errors sending on a kept-alive connection that mean the service had
+# already closed it
+_CONNECTION_CLOSED_ERRNOS = (errno.ECONNRESET, errno.EPIPE,
+                             errno.ECONNABORTED)
+# Largest payload whose base64 encoding, with a codec tag, fits the 8KB
+# limit on message text
+MAX_PAYLOAD_SIZE = 6000
+# Envelopes start with ENVELOPE_MAGIC followed by their items, each
+# preceded by its length as an ENVELOPE_LENGTH struct
+ENVELOPE_MAGIC = "\x00pyz1"
+ENVELOPE_LENGTH = struct.Struct(">H")
+
+class QueueMessage(object):
+    """Message retrieved from a queue. text is the decoded payload, or the
+    raw message text if decoding failed with decode_error; id and
+    pop_receipt identify it to delete_message."""
+
+    __slots__ = ("id", "pop_receipt", "text", "insertion_time",
+                 "expiration_time", "time_next_visible", "dequeue_count",
+                 "decode_error")
+
+    def __init__(self, id=None, pop_receipt=None, text=None,
+            insertion_time=None, expiration_time=None,
+            time_next_visible=None, dequeue_count=None, decode_error=None):
+        self.id = id
+        self.pop_receipt = pop_receipt
+        self.text = text
+        self.insertion_time = insertion_time
+        self.expiration_time = expiration_time
+        self.time_next_visible = time_next_visible
+        self.dequeue_count = dequeue_count
+        self.decode_error = decode_error
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "QueueMessage(%r)" % self.id
+
+# Elements of a QueueMessage in a Get Messages response and the attributes
+# they are parsed into
+_MESSAGE_FIELDS = {
+    "MessageId": "id",
+    "PopReceipt": "pop_receipt",
+    "MessageText": "text",
+    "InsertionTime": "insertion_time",
+    "ExpirationTime": "expiration_time",
+    "TimeNextVisible": "time_next_visible",
+    "DequeueCount": "dequeue_count",
+}
+
+class MessageCodec(object):
+    """Encoding of payloads into message text. The text of every codec but
+    the default starts with its tag, a "~" and a letter, which base64 never
+    does, so get_messages can tell which codec to decode a message with."""
+
+    def __init__(self, name, tag, encode, decode):
+        self.name = name
+        self.tag = tag
+        self.encode = encode
+        self.decode = decode
+
+    def __repr__(self):
+        return "MessageCodec(%r)" % self.name
+
+def _encode_text(payload):
+    if isinstance(payload, unicode):
+        return payload.encode("utf-8")
+    return payload
+
+# base64 is the default: its untagged text is what put_message has always
+# sent, so older consumers can still read it. text sends payloads as they
+# are, which must be characters XML allows; zlib compresses them; json
+# serializes structures of lists, dicts, strings and numbers, and is safe to
+# decode whoever enqueued the message.
+MESSAGE_CODECS = {
+    "base64": MessageCodec("base64", "", base64.b64encode, base64.b64decode),
+    "text": MessageCodec("text", "~t", _encode_text, lambda text: text),
+    "zlib": MessageCodec("zlib", "~z",
+        lambda payload: base64.b64encode(zlib.compress(payload)),
+        lambda text: zlib.decompress(base64.b64decode(text))),
+    "json": MessageCodec("json", "~j",
+        lambda payload: json.dumps(payload, separators=(",", ":")),
+        json.loads),
+}
+
+def get_message_codec(codec):
+    """Returns the MessageCodec given or named by codec."""
+    if isinstance(codec, MessageCodec):
+        return codec
+    try:
+        return MESSAGE_CODECS[codec]
+    except KeyError:
+        raise WAError("Unknown message codec %r" % codec)
+
+def encode_message(payload, codec="base64"):
+    """Returns the message text of payload encoded with codec."""
+    codec = get_message_codec(codec)
+    return codec.tag + codec.encode(payload)
+
+def decode_message(text):
+    """Returns the payload of a message text, decoded with the codec its
+    tag names."""
+    if text.startswith("~"):
+        tag = text[:2]
+        for codec in MESSAGE_CODECS.itervalues():
+            if codec.tag == tag:
+                return codec.decode(text[2:])
+        raise WAError("Unknown message codec tag %r" % tag)
+    return base64.b64decode(text)
+
+def pack_messages(payloads, max_size=MAX_PAYLOAD_SIZE):
+    """Packs payloads, in order, into as few envelopes of at most max_size
+    bytes as it can and yields them as they fill up. Each envelope is sent
+    as one message, e.g. with put_messages, and unpacked by
+    unpack_message."""
+    limit = max_size - len(ENVELOPE_MAGIC)
+    parts = [ENVELOPE_MAGIC]
+    size = 0
+    for payload in payloads:
+        item_size = ENVELOPE_LENGTH.size + len(payload)
+        if item_size > limit:
+            raise ValueError("payload of %d bytes does not fit in an "
+                "envelope of %d bytes" % (len(payload), max_size))
+        if size + item_size > limit:
+            yield "".join(parts)
+            parts = [ENVELOPE_MAGIC]
+            size = 0
+        parts.append(ENVELOPE_LENGTH.pack(len(payload)))
+        parts.append(payload)
+        size += item_size
+    if size:
+        yield "".join(parts)
+
+def unpack_message(text):
+    """Returns the list of payloads packed in an envelope by pack_messages,
+    or [text] for a message that is not an envelope."""
+    if not text.startswith(ENVELOPE_MAGIC):
+        return [text]
+    payloads = []
+    offset = len(ENVELOPE_MAGIC)
+    while offset < len(text):
+        if offset + ENVELOPE_LENGTH.size > len(text):
+            raise WAError("Truncated envelope")
+        length, = ENVELOPE_LENGTH.unpack_from(text, offset)
+        offset += ENVELOPE_LENGTH.size
+        if offset + length > len(text):
+            raise WAError("Truncated envelope")
+        payloads.append(text[offset:offset + length])
+        offset += length
+    return payloads
 
 class Queue(object):
     def __init__(self, name="", url="", metadata=None):
@@ -137,33 +309,109 @@ class QueueStorage(Storage):
             else:
                 return result
 
-    def put_message(self, queue_name, payload):
-        data = "<QueueMessage><MessageText>%s</MessageText></QueueMessage>" % base64.encodestring(payload)
-        req = RequestWithMethod("POST", "%s/%s/messages" % (self.get_base_url(), queue_name), data=data)
-        req.add_header("Content-Type", "application/xml")
-        req.add_header("Content-Length", len(data))
-        self._credentials.sign_request(req)
+    def put_message(self, queue_name, payload, codec="base64"):
+        """Enqueues payload encoded with codec, a MessageCodec or the name
+        of one in MESSAGE_CODECS, and returns the HTTP status code."""
+        req = self._make_put_message_request(queue_name, payload, codec)
         try:
             response = urlopen(req)
             return response.code
         except URLError, e:
             return e.code
 
-    def get_message(self, queue_name):
-        req = Request("%s/%s/messages" % (self.get_base_url(), queue_name))
+    def put_messages(self, queue_name, payloads,
+            concurrency=DEFAULT_CONCURRENCY, progress=None, codec="base64",
+            timeout=CONNECTION_TIMEOUT):
+        """Enqueues each of payloads, encoded with codec, with up to
+        concurrency requests in flight and returns a BulkResult.
+
+        Each worker thread keeps one HTTP connection open for all the
+        messages it sends, and gives up on a request after timeout seconds
+        without progress. A message is only sent again when the kept-alive
+        connection turns out to have been closed by the service before it
+        answered, so none is enqueued twice. Failed messages are recorded
+        in the result's errors by their index in payloads, with the HTTP
+        status code or exception; every other message was enqueued. The
+        result's elapsed and rate give the throughput. progress, if given,
+        is called with the BulkResult after each message."""
+        codec = get_message_codec(codec)
+        local = threading.local()
+        connections = []
+        connections_lock = threading.Lock()
+
+        def put(item):
+            req = self._make_put_message_request(queue_name, item[1],
+                codec)
+            connection = getattr(local, "connection", None)
+            if connection is None:
+                connection = local.connection = \
+                    httplib.HTTPConnection(req.get_host(), timeout=timeout)
+                with connections_lock:
+                    connections.append(connection)
+            return self._send(connection, req)
+
+        result = BulkResult()
+        try:
+            for item, code, error in parallel_imap(put, enumerate(payloads),
+                    concurrency):
+                if error is None and code != 201:
+                    error = code
+                result.add(item[0], error)
+                if progress is not None:
+                    progress(result)
+        finally:
+            for connection in connections:
+                connection.close()
+        result.finish()
+        return result
+
+    def get_message(self, queue_name, visibility_timeout=None):
+        """Returns the next visible message of the queue, or None."""
+        messages = self.get_messages(queue_name, 1, visibility_timeout)
+        if messages:
+            return messages[0]
+        return None
+
+    def get_messages(self, queue_name, num_messages=MAX_MESSAGES_PER_GET,
+            visibility_timeout=None):
+        """Returns a list of up to num_messages (at most 32) visible
+        messages of the queue, empty when there are none. They stay
+        invisible to other consumers for visibility_timeout seconds, or the
+        service's default of 30. Each message's text is decoded with the
+        codec it was put with; a message that fails to decode keeps its raw
+        text and has the exception in decode_error."""
+        if not 1 <= num_messages <= MAX_MESSAGES_PER_GET:
+            raise ValueError("num_messages must be between 1 and %d"
+                % MAX_MESSAGES_PER_GET)
+        request_string = "%s/%s/messages" % (self.get_base_url(), queue_name)
+        if num_messages != 1:
+            request_string = add_url_parameter(request_string,
+                "numofmessages", num_messages)
+        if visibility_timeout is not None:
+            request_string = add_url_parameter(request_string,
+                "visibilitytimeout", visibility_timeout)
+        req = Request(request_string)
         self._credentials.sign_request(req)
         response = urlopen(req)
         dom = etree.fromstring(response.read())
-        messages = dom.findall('QueueMessage')
-        result = None
-        if len(messages) == 1:
-            message = messages[0]
-            result = QueueMessage()
-            result.id = message.find('MessageId').text
-            result.pop_receipt = message.find('PopReceipt').text
-            result.text = base64.decodestring(
-                message.find('MessageText').text)
-        return result
+        messages = []
+        for element in dom:
+            message = QueueMessage()
+            for field in element:
+                name = _MESSAGE_FIELDS.get(field.tag)
+                if name is not None:
+                    setattr(message, name, field.text)
+            try:
+                message.text = decode_message(message.text or "")
+            except Exception, e:
+                # keep the raw text so the rest of the batch gets through
+                log.warning("Decoding message %s of %s failed: %s",
+                    message.id, queue_name, e)
+                message.decode_error = e
+            if message.dequeue_count is not None:
+                message.dequeue_count = int(message.dequeue_count)
+            messages.append(message)
+        return messages
 
     def delete_message(self, queue_name, message):
         id = message.id
@@ -176,6 +424,47 @@ class QueueStorage(Storage):
         except URLError, e:
             return e.code
     
+    def _make_put_message_request(self, queue_name, payload, codec):
+        data = ("<QueueMessage><MessageText>%s</MessageText></QueueMessage>"
+                % escape(encode_message(payload, codec)))
+        req = RequestWithMethod("POST", "%s/%s/messages" % (self.get_base_url(), queue_name), data=data)
+        req.add_header("Content-Type", "application/xml")
+        req.add_header("Content-Length", len(data))
+        self._credentials.sign_request(req)
+        return req
+
+    def _send(self, connection, req):
+        """Sends a prepared request over a kept-alive connection and returns
+        the HTTP status code, reading the response so the connection can be
+        reused. The request is sent again on a new connection only if the
+        reused one was found closed by the service before any response."""
+        request = lambda: connection.request(req.get_method(),
+            req.get_selector(), req.get_data(), dict(req.header_items()))
+        reused = connection.sock is not None
+        try:
+            try:
+                request()
+            except socket.error, e:
+                if not reused or e.errno not in _CONNECTION_CLOSED_ERRNOS:
+                    raise
+                connection.close()
+                request()
+                reused = False
+            try:
+                response = connection.getresponse()
+            except httplib.BadStatusLine:
+                if not reused:
+                    raise
+                connection.close()
+                request()
+                response = connection.getresponse()
+            response.read()
+            return response.status
+        except Exception:
+            # a connection left mid-request cannot be reused
+            connection.close()
+            raise
+
     def _parse_queue(self, entry):
         queue = Queue()
         queue.name = entry.find("QueueName").text
@@ -206,3 +495,247 @@ class QueueStorage(Storage):
             # Messages until it succeeds, to ensure that all messages have been
             # deleted.
             return e.code
+
+class BackoffPoller(object):
+    """Paces the polls of a queue consumer: polls follow each other at once
+    while they return messages, and back off exponentially with jitter,
+    from min_delay up to max_delay seconds, while the queue is empty.
+
+    With queues and queue_name, each backed-off wait ends with a probe of
+    the queue's approximate message count, and the backoff continues
+    without a poll while it is 0. A poller is meant for a single consumer
+    thread."""
+
+    def __init__(self, min_delay=0.1, max_delay=30.0, multiplier=2.0,
+            jitter=0.5, queues=None, queue_name=None):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self._queues = queues
+        self.queue_name = queue_name
+        self._empty_streak = 0
+        self.busy_polls = 0
+        self.idle_polls = 0
+        self.probes = 0
+        self.messages = 0
+        self.idle_time = 0.0
+
+    def record(self, count):
+        """Records a poll that returned count messages and returns the
+        seconds to wait before the next one."""
+        if count:
+            self.busy_polls += 1
+            self.messages += count
+            self._empty_streak = 0
+            return 0
+        self.idle_polls += 1
+        return self._backoff()
+
+    def probe(self):
+        """Called at the end of a wait, returns 0 when the next poll should
+        be made, or the seconds to wait further when probing finds the
+        queue empty."""
+        if self._queues is None:
+            return 0
+        self.probes += 1
+        try:
+            result = self._queues.get_queue_metadata(self.queue_name)
+        except Exception, e:
+            log.warning("Probing %s failed: %s", self.queue_name, e)
+            return 0
+        if isinstance(result, tuple) and result[0] is not None and \
+                int(result[0]) == 0:
+            return self._backoff()
+        return 0
+
+    def stats(self):
+        """Returns a dict of the poll counts, the messages received and the
+        total seconds of waiting handed out."""
+        polls = self.busy_polls + self.idle_polls
+        return dict(polls=polls, busy_polls=self.busy_polls,
+                    idle_polls=self.idle_polls, probes=self.probes,
+                    messages=self.messages, idle_time=self.idle_time,
+                    busy_ratio=float(self.busy_polls) / polls if polls else 0)
+
+    def _backoff(self):
+        delay = self.min_delay * self.multiplier ** self._empty_streak
+        # the streak stops growing once the delay is capped, which keeps
+        # the power from overflowing on a queue that stays empty
+        if 0 < delay < self.max_delay:
+            self._empty_streak += 1
+        delay = min(self.max_delay, delay)
+        delay *= 1 - self.jitter * random.random()
+        self.idle_time += delay
+        return delay
+
+class QueueConsumer(object):
+    """Processes the messages of a queue with a pool of concurrency workers.
+
+    A fetcher thread keeps up to prefetch messages buffered, getting them
+    in batches with get_messages. It stops fetching while the buffer is
+    full, so messages do not sit out their visibility timeout waiting for
+    busy workers. Each worker calls handler with a QueueMessage and deletes
+    the message when handler returns. A message whose handler raises, or
+    that could not be decoded, is left to reappear after its visibility
+    timeout.
+
+    With use_processes, handlers run in a multiprocessing pool of
+    concurrency processes instead of in the worker threads; handler must
+    then be picklable, e.g. a module-level function.
+
+    Polls are paced by poller, by default a BackoffPoller; its stats tell
+    how busy the queue has been.
+
+    Envelopes made by pack_messages are unpacked unless unpack is false:
+    handler is called with a QueueMessage per payload, in order, and the
+    envelope is deleted once all of them succeed. If one fails, the whole
+    envelope comes back after its visibility timeout, so its earlier
+    payloads are handled again. processed counts payloads handled."""
+
+    def __init__(self, queues, queue_name, handler, concurrency=8,
+            prefetch=MAX_MESSAGES_PER_GET, visibility_timeout=None,
+            use_processes=False, poller=None, unpack=True):
+        if concurrency < 1:
+            raise ValueError("concurrency must be 1 or greater")
+        if prefetch < 1:
+            raise ValueError("prefetch must be 1 or greater")
+        self._queues = queues
+        self.queue_name = queue_name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        self.visibility_timeout = visibility_timeout
+        self.use_processes = use_processes
+        self.poller = poller if poller is not None else BackoffPoller()
+        self.unpack = unpack
+        self.processed = 0
+        self.failed = 0
+        self._buffer = deque()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        self._pool = None
+
+    def start(self):
+        """Starts fetching and processing messages in the background."""
+        if self._threads:
+            raise WAError("QueueConsumer already started")
+        self._stopping = False
+        if self.use_processes:
+            import multiprocessing
+            self._pool = multiprocessing.Pool(self.concurrency)
+        self._threads.append(threading.Thread(target=self._fetch))
+        self._threads.extend(threading.Thread(target=self._work)
+                             for _ in xrange(self.concurrency))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stops fetching, waits for the workers to process the messages
+        already buffered and shuts them down."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def run(self, duration=None):
+        """Consumes the queue in the calling thread's stead until duration
+        seconds have passed, or until interrupted when it is None."""
+        self.start()
+        try:
+            deadline = None if duration is None else time.time() + duration
+            while deadline is None or time.time() < deadline:
+                time.sleep(0.5 if deadline is None
+                           else max(0, min(0.5, deadline - time.time())))
+        finally:
+            self.stop()
+
+    def _fetch(self):
+        while True:
+            with self._condition:
+                while len(self._buffer) >= self.prefetch and \
+                        not self._stopping:
+                    self._condition.wait(0.5)
+                if self._stopping:
+                    return
+                wanted = min(self.prefetch - len(self._buffer),
+                             MAX_MESSAGES_PER_GET)
+            try:
+                messages = self._queues.get_messages(self.queue_name,
+                    wanted, self.visibility_timeout)
+            except Exception, e:
+                log.warning("Getting messages from %s failed: %s",
+                    self.queue_name, e)
+                messages = []
+            if messages:
+                with self._condition:
+                    self._buffer.extend(messages)
+                    self._condition.notify_all()
+            try:
+                delay = self.poller.record(len(messages))
+                while delay and not self._stopping:
+                    self._sleep(delay)
+                    delay = self.poller.probe()
+            except Exception, e:
+                log.warning("Pacing the polls of %s failed: %s",
+                    self.queue_name, e)
+                self._sleep(POLLER_ERROR_DELAY)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._buffer and not self._stopping:
+                    self._condition.wait(0.5)
+                if not self._buffer:
+                    return
+                message = self._buffer.popleft()
+                self._condition.notify_all()
+            if message.decode_error is not None:
+                self._count("failed")
+                continue
+            items = [message]
+            try:
+                # a malformed envelope fails like a handler error
+                if self.unpack and isinstance(message.text, str) and \
+                        message.text.startswith(ENVELOPE_MAGIC):
+                    items = []
+                    for payload in unpack_message(message.text):
+                        item = QueueMessage(*message.__getstate__())
+                        item.text = payload
+                        items.append(item)
+                for item in items:
+                    if self._pool is not None:
+                        self._pool.apply(self.handler, (item,))
+                    else:
+                        self.handler(item)
+            except Exception, e:
+                log.warning("Handling message %s of %s failed: %s",
+                    message.id, self.queue_name, e)
+                self._count("failed")
+                continue
+            try:
+                code = self._queues.delete_message(self.queue_name, message)
+            except Exception, e:
+                code = e
+            if code != 204:
+                log.warning("Deleting message %s of %s failed: %s",
+                    message.id, self.queue_name, code)
+            self._count("processed", len(items))
+
+    def _count(self, name, n=1):
+        with self._condition:
+            setattr(self, name, getattr(self, name) + n)
+
+    def _sleep(self, seconds):
+        """Sleeps for seconds or until stop is called."""
+        with self._condition:
+            if not self._stopping:
+                self._condition.wait(seconds)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Python wrapper around Windows Azure storage and management APIs
+
+Authors:
+    Sriram Krishnan <sriramk@microsoft.com>
+    Steve Marx <steve.marx@microsoft.com>
+    Tihomir Petkov <tpetkov@gmail.com>
+
+License:
+    GNU General Public Licence (GPL)
+    
+    This file is part of pyazure.
+    
+    pyazure is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pyazure is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with pyazure. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import tempfile
+
+from util import *
+from blob import DEFAULT_CONCURRENCY, DOWNLOAD_RANGE_SIZE, CODEC_METADATA, \
+    SIZE_METADATA
+
+# Name of the state file kept in the synced directory by default
+STATE_FILE_NAME = ".pyazure-sync"
+# Suffix of the temporary files downloads are written to
+PARTIAL_SUFFIX = ".pyazure-part"
+
+def file_md5(path):
+    """Returns the base64 MD5 of a file, as used by the Content-MD5
+    property."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter_chunks(f, 1024 * 1024):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest())
+
+def replace_file(source, destination):
+    """Renames source over destination, which os.rename alone does not do on
+    Windows."""
+    try:
+        os.rename(source, destination)
+    except OSError:
+        os.remove(destination)
+        os.rename(source, destination)
+
+def get_content_size(blob):
+    """Returns the size of a listed blob's contents as downloaded, which for
+    a blob uploaded with a codec is its uncompressed size."""
+    if blob.metadata and CODEC_METADATA in blob.metadata:
+        return int(blob.metadata[SIZE_METADATA])
+    return blob.size
+
+def get_content_md5(blob):
+    """Returns the Content-MD5 of a listed blob's contents as downloaded, or
+    None when it is not known; that of a blob uploaded with a codec is the
+    MD5 of the compressed bytes."""
+    if blob.metadata and CODEC_METADATA in blob.metadata:
+        return None
+    return blob.content_md5
+
+class SyncResult(object):
+    """Outcome of a BlobSync run: the relative paths transferred and deleted,
+    the number of files found unchanged and the (path, exception) pairs of
+    the files that failed."""
+
+    def __init__(self):
+        self.transferred = []
+        self.deleted = []
+        self.unchanged = 0
+        self.errors = []
+
+class BlobSync(object):
+    """Keeps a local directory and the blobs under a prefix of a container
+    in step, transferring only the files that differ.
+
+    Files are compared by size and Content-MD5. A state file records the
+    size, modification time, MD5 and ETag of every file as of the last sync,
+    so that unchanged files are recognised without hashing them again.
+    Uploads set the blob's Content-MD5 for later comparisons."""
+
+    def __init__(self, blobs, container_name, local_dir, prefix="",
+            state_file=None, concurrency=DEFAULT_CONCURRENCY):
+        self._blobs = blobs
+        self.container_name = container_name
+        self.local_dir = local_dir
+        self.prefix = prefix
+        if state_file is None:
+            state_file = os.path.join(local_dir, STATE_FILE_NAME)
+        self.state_file = state_file
+        self.concurrency = concurrency
+
+    def upload(self, delete=False):
+        """Uploads new and changed files. With delete, blobs under the prefix
+        that have no local file are deleted. Returns a SyncResult."""
+        state = self._load_state()
+        local = self._list_local()
+        remote = self._list_remote()
+        result = SyncResult()
+
+        def sync(path):
+            size, mtime = local[path]
+            known = state.get(path)
+            blob = remote.get(path)
+            md5 = None
+            if known and (known["size"], known["mtime"]) == (size, mtime):
+                md5 = known["md5"]
+            if blob is not None and get_content_size(blob) == size:
+                if md5 is not None and blob.etag == known["etag"]:
+                    return False, known
+                if md5 is None:
+                    md5 = file_md5(self._local_path(path))
+                if get_content_md5(blob) == md5:
+                    return False, dict(size=size, mtime=mtime, md5=md5,
+                                       etag=blob.etag)
+            if md5 is None:
+                md5 = file_md5(self._local_path(path))
+            with open(self._local_path(path), "rb") as f:
+                code = self._blobs.put_blob(self.container_name,
+                    self.prefix + path, f, content_md5=md5)
+            if code != 201:
+                raise WAError("Put Blob of %s returned %d" % (path, code))
+            # the ETag is learnt from the next listing
+            return True, dict(size=size, mtime=mtime, md5=md5, etag=None)
+
+        self._run(sync, local, state, result)
+        if delete:
+            def remove(path):
+                code = self._blobs.delete_blob(self.container_name,
+                    self.prefix + path)
+                if code not in (202, 404):
+                    raise WAError("Delete Blob of %s returned %d"
+                        % (path, code))
+            self._delete(remove, set(remote) - set(local), state, result)
+        self._save_state(state)
+        return result
+
+    def download(self, delete=False):
+        """Downloads new and changed blobs. With delete, local files that
+        have no blob under the prefix are deleted. Returns a SyncResult."""
+        state = self._load_state()
+        local = self._list_local()
+        remote = self._list_remote()
+        result = SyncResult()
+
+        def sync(path):
+            blob = remote[path]
+            known = state.get(path)
+            if path in local:
+                size, mtime = local[path]
+                unchanged = known and (known["size"], known["mtime"]) == \
+                    (size, mtime)
+                if unchanged and known["etag"] == blob.etag:
+                    return False, known
+                content_md5 = get_content_md5(blob)
+                if size == get_content_size(blob) and content_md5 is not None:
+                    if unchanged and known["md5"] is not None:
+                        md5 = known["md5"]
+                    else:
+                        md5 = file_md5(self._local_path(path))
+                    if md5 == content_md5:
+                        return False, dict(size=size, mtime=mtime, md5=md5,
+                                           etag=blob.etag)
+            self._fetch(blob, path)
+            stat = os.stat(self._local_path(path))
+            return True, dict(size=stat.st_size, mtime=stat.st_mtime,
+                              md5=get_content_md5(blob), etag=blob.etag)
+
+        self._run(sync, remote, state, result)
+        if delete:
+            def remove(path):
+                os.remove(self._local_path(path))
+            self._delete(remove, set(local) - set(remote), state, result)
+        self._save_state(state)
+        return result
+
+    def _run(self, sync, paths, state, result):
+        for path, outcome, error in parallel_imap(sync, sorted(paths),
+                self.concurrency):
+            if error is not None:
+                result.errors.append((path, error))
+                continue
+            transferred, entry = outcome
+            state[path] = entry
+            if transferred:
+                result.transferred.append(path)
+            else:
+                result.unchanged += 1
+
+    def _delete(self, remove, paths, state, result):
+        for path, _, error in parallel_imap(remove, sorted(paths),
+                self.concurrency):
+            if error is not None:
+                result.errors.append((path, error))
+            else:
+                state.pop(path, None)
+                result.deleted.append(path)
+
+    def _fetch(self, blob, path):
+        destination = self._local_path(path)
+        directory = os.path.dirname(destination)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created meanwhile by another worker
+                if not os.path.isdir(directory):
+                    raise
+        fd, partial = tempfile.mkstemp(suffix=PARTIAL_SUFFIX, dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                name = self.prefix + path
+                if get_content_size(blob) > DOWNLOAD_RANGE_SIZE:
+                    self._blobs.get_blob_into(self.container_name, name, f)
+                else:
+                    for chunk in self._blobs.iter_blob(self.container_name,
+                            name):
+                        f.write(chunk)
+            replace_file(partial, destination)
+        except:
+            os.remove(partial)
+            raise
+
+    def _list_local(self):
+        """Returns {relative path: (size, mtime)} for the local files."""
+        files = {}
+        state_file = os.path.abspath(self.state_file)
+        for directory, _, names in os.walk(self.local_dir):
+            for name in names:
+                local_path = os.path.join(directory, name)
+                if name.endswith(PARTIAL_SUFFIX) or \
+                        os.path.abspath(local_path) == state_file:
+                    continue
+                path = os.path.relpath(local_path, self.local_dir)
+                stat = os.stat(local_path)
+                files[path.replace(os.sep, "/")] = (stat.st_size,
+                                                    stat.st_mtime)
+        return files
+
+    def _list_remote(self):
+        """Returns {relative path: Blob} for the blobs under the prefix."""
+        blobs = {}
+        # metadata tells the contents of blobs uploaded with a codec
+        for blob in self._blobs.list_blobs(self.container_name, self.prefix,
+                                           include_metadata=True):
+            path = blob.name[len(self.prefix):]
+            # skip virtual directory placeholders
+            if path and not path.endswith("/"):
+                blobs[path] = blob
+        return blobs
+
+    def _local_path(self, path):
+        """Maps a blob path to its file under local_dir. Paths with empty,
+        "." or ".." components, or that would resolve outside local_dir,
+        raise WAError rather than letting a blob name pick the file."""
+        parts = path.split("/")
+        if "" in parts or "." in parts or ".." in parts:
+            raise WAError("%r is not a safe relative path" % path)
+        local_path = os.path.join(self.local_dir, *parts)
+        root = os.path.join(os.path.abspath(self.local_dir), "")
+        if not os.path.abspath(local_path).startswith(root):
+            raise WAError("%r resolves outside %s" % (path, self.local_dir))
+        return local_path
+
+    def _load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def _save_state(self, state):
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        fd, partial = tempfile.mkstemp(suffix=PARTIAL_SUFFIX, dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        replace_file(partial, self.state_file)
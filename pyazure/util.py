@@ -38,6 +38,8 @@ import hashlib
 import urllib2
 import httplib
 import os.path
+import threading
+import Queue
 from urlparse import urlsplit, urljoin
 from datetime import datetime, timedelta
 from StringIO import StringIO
@@ -77,6 +79,11 @@ PREFIX_STORAGE_HEADER = "x-ms-"
 MANAGEMENT_VERSION_HEADER = "x-ms-version"
 MANAGEMENT_VERSION = "2011-10-01"
 
+# Storage requests carrying this header are signed with SharedKeyLite, which
+# the storage services accept for every API version
+STORAGE_VERSION_HEADER = PREFIX_STORAGE_HEADER + "version"
+STORAGE_VERSION = "2012-02-12"
+
 NEW_LINE = "\x0A"
 TIME_FORMAT ="%a, %d %b %Y %H:%M:%S %Z"
 
@@ -129,6 +136,44 @@ class WASMError(WAError):
             user_message)
 
 
+class BulkResult(object):
+    """Counters and per-item errors of a bulk operation, updated as each item
+    completes. errors holds (item, error) pairs, error being the HTTP status
+    code or the exception the item failed with. elapsed counts from the
+    creation of the result until finish is called."""
+
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def completed(self):
+        return self.succeeded + self.failed
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        """Items completed per second."""
+        elapsed = self.elapsed
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+    def finish(self):
+        self.finished = time.time()
+
+    def add(self, item, error=None):
+        if error is None:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+            self.errors.append((item, error))
+
+
 # Helper functions
 ################################################################################
 def add_url_parameter(request_string, key, value):
@@ -374,6 +419,131 @@ def retry(retries, delay=2, backoff=2, delay_ceiling=0, percolate_excs=()):
         return f_retry # true decorator -> decorated function
     return deco_retry  # @retry(arg[, ...]) -> true decorator
 
+def get_data_length(data):
+    """Returns the number of bytes that will be read from data, which may be
+    a string or buffer, or a file-like object read from its current position.
+    Returns None when the length cannot be known in advance. unicode text
+    is refused, as its length in bytes depends on how it is encoded."""
+    if isinstance(data, unicode):
+        raise TypeError("unicode data must be encoded to bytes first")
+    if hasattr(data, "read"):
+        try:
+            position = data.tell()
+            data.seek(0, os.SEEK_END)
+            length = data.tell() - position
+            data.seek(position)
+            return length
+        except (AttributeError, IOError, OSError):
+            return None
+    if isinstance(data, (str, bytearray, memoryview, buffer)):
+        return len(data)
+    return None
+
+def iter_chunks(data, chunk_size):
+    """Yields data in chunk_size pieces without holding more than a chunk in
+    memory. data may be anything get_data_length accepts, or an iterable of
+    strings of any size; only the last chunk may be shorter."""
+    if isinstance(data, unicode):
+        raise TypeError("unicode data must be encoded to bytes first")
+    if hasattr(data, "read"):
+        while True:
+            chunk = data.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    elif isinstance(data, (str, bytearray, memoryview, buffer)):
+        for offset in xrange(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+    else:
+        pending, size = [], 0
+        for piece in data:
+            pending.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                joined = "".join(pending)
+                end = size - size % chunk_size
+                for offset in xrange(0, end, chunk_size):
+                    yield joined[offset:offset + chunk_size]
+                pending, size = [joined[end:]], size - end
+        if size:
+            yield "".join(pending)
+
+def parallel_imap(func, iterable, concurrency=4, ordered=False,
+        max_pending=None):
+    """Lazily applies func to the items of iterable on concurrency worker
+    threads and yields an (item, result, error) tuple for each of them.
+
+    error is None on success, otherwise it is the exception raised by func
+    and result is None. No more than max_pending items (twice concurrency by
+    default) are taken from iterable before their results have been yielded,
+    so iterable may be a stream of large chunks without memory growing.
+    Results come out in completion order unless ordered is True. Exceptions
+    raised by iterable itself propagate to the caller."""
+
+    if concurrency < 1:
+        raise ValueError("concurrency must be 1 or greater")
+    if max_pending is None:
+        max_pending = 2 * concurrency
+    if max_pending < concurrency:
+        raise ValueError("max_pending must not be less than concurrency")
+
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, item = task
+            try:
+                results.put((index, item, func(item), None))
+            except Exception, e:
+                results.put((index, item, None, e))
+
+    workers = []
+    for _ in xrange(concurrency):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    items = iter(iterable)
+    submitted = 0
+    yielded = 0
+    exhausted = False
+    completed = {}
+    try:
+        while True:
+            while not exhausted and submitted - yielded < max_pending:
+                try:
+                    item = items.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                tasks.put((submitted, item))
+                submitted += 1
+            if yielded == submitted:
+                return
+            if ordered:
+                while yielded not in completed:
+                    result = results.get()
+                    completed[result[0]] = result
+                result = completed.pop(yielded)
+            else:
+                result = results.get()
+            yielded += 1
+            yield result[1:]
+    finally:
+        # drop whatever has not been started yet and let the workers exit
+        try:
+            while True:
+                tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for _ in workers:
+            tasks.put(None)
+
 def build_wasm_request_body(xml_as_odict, builder=None, root=True, indent=0):
     """Takes an OrderedDict and uses it to build an XML doc suitable for
     sending as a request body to the Windows Azure Management Service. This
@@ -428,7 +598,9 @@ class SharedKeyCredentials(object):
 
         # verb
         string_to_sign = request.get_method().upper() + NEW_LINE
-        # MD5 not required
+        # MD5 is optional, but has to be signed when it is sent
+        if request.get_header('Content-md5') is not None:
+            string_to_sign += request.get_header('Content-md5')
         string_to_sign += NEW_LINE
         # Content-Type
         if request.get_header('Content-type') is not None:
@@ -445,7 +617,11 @@ class SharedKeyCredentials(object):
         # Canonicalized resource
         string_to_sign += canonicalized_resource
         
-        request.add_header('Authorization', 'SharedKey ' + self._account + ':'
+        if request.has_header(STORAGE_VERSION_HEADER.capitalize()):
+            scheme = 'SharedKeyLite '
+        else:
+            scheme = 'SharedKey '
+        request.add_header('Authorization', scheme + self._account + ':'
             + base64.encodestring(hmac.new(self._key,
             unicode(string_to_sign).encode("utf-8"),
             hashlib.sha256).digest()).strip())
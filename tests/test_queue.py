@@ -0,0 +1,124 @@
+import threading
+import time
+import unittest
+
+from pyazure import queue
+from pyazure.queue import BackoffPoller, QueueConsumer, QueueMessage, \
+    pack_messages, unpack_message
+from pyazure.util import WAError
+
+class FakeQueues(object):
+    """Stands in for QueueStorage: get_messages hands out the messages
+    added with add, and delete_message records what it is given."""
+
+    def __init__(self):
+        self.messages = []
+        self.deleted = []
+        self._lock = threading.Lock()
+
+    def add(self, text):
+        with self._lock:
+            self.messages.append(QueueMessage(str(len(self.messages)),
+                                              "receipt", text))
+
+    def get_messages(self, queue_name, num_messages, visibility_timeout):
+        with self._lock:
+            messages = self.messages[:num_messages]
+            del self.messages[:num_messages]
+        return messages
+
+    def delete_message(self, queue_name, message):
+        self.deleted.append(message.id)
+        return 204
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class EnvelopeTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        payloads = ["a", "", "b" * 100]
+        envelope, = pack_messages(payloads)
+        self.assertEqual(unpack_message(envelope), payloads)
+
+    def test_truncated_envelope(self):
+        envelope, = pack_messages(["abc", "de"])
+        # cut inside the last payload, then inside its length
+        for end in (len(envelope) - 1, len(envelope) - 3):
+            self.assertRaises(WAError, unpack_message, envelope[:end])
+
+class BackoffPollerTest(unittest.TestCase):
+
+    def test_long_idle_streak_stays_at_max_delay(self):
+        poller = BackoffPoller(min_delay=0.1, max_delay=30.0, jitter=0)
+        for _ in xrange(2000):
+            delay = poller.record(0)
+        self.assertEqual(delay, 30.0)
+        self.assertEqual(poller.record(1), 0)
+        self.assertEqual(poller.record(0), 0.1)
+
+    def test_zero_min_delay(self):
+        poller = BackoffPoller(min_delay=0, jitter=0)
+        for _ in xrange(2000):
+            self.assertEqual(poller.record(0), 0)
+
+class FailingPoller(BackoffPoller):
+
+    def __init__(self):
+        BackoffPoller.__init__(self, min_delay=0.01, max_delay=0.01)
+        self.failures = 0
+
+    def record(self, count):
+        if not self.failures:
+            self.failures += 1
+            raise RuntimeError("poller failed")
+        return BackoffPoller.record(self, count)
+
+class QueueConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.poller_error_delay = queue.POLLER_ERROR_DELAY
+        queue.POLLER_ERROR_DELAY = 0.01
+
+    def tearDown(self):
+        queue.POLLER_ERROR_DELAY = self.poller_error_delay
+
+    def test_fetcher_survives_poller_error(self):
+        queues = FakeQueues()
+        handled = []
+        poller = FailingPoller()
+        consumer = QueueConsumer(queues, "q", handled.append,
+                                 concurrency=1, poller=poller)
+        consumer.start()
+        try:
+            self.assertTrue(wait_for(lambda: poller.failures))
+            queues.add("hello")
+            self.assertTrue(wait_for(lambda: consumer.processed == 1))
+        finally:
+            consumer.stop()
+        self.assertEqual([m.text for m in handled], ["hello"])
+
+    def test_bad_envelope_counts_as_failed(self):
+        queues = FakeQueues()
+        envelope, = pack_messages(["abc", "de"])
+        queues.add(envelope[:-1])
+        queues.add(envelope + "x")
+        queues.add(envelope)
+        handled = []
+        consumer = QueueConsumer(queues, "q", handled.append,
+                                 concurrency=1)
+        consumer.start()
+        try:
+            self.assertTrue(wait_for(
+                lambda: consumer.processed + consumer.failed == 4))
+        finally:
+            consumer.stop()
+        self.assertEqual(consumer.failed, 2)
+        self.assertEqual([m.text for m in handled], ["abc", "de"])
+        self.assertEqual(queues.deleted, ["2"])
+
+if __name__ == "__main__":
+    unittest.main()